@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks do Processador de Sorteios.
+
+Cada benchmark compara a implementação atual de main.py com a versão anterior
+(reproduzida aqui como referência) e confere que os resultados batem.
+
+Uso:
+    python benchmark.py                 # roda todos
+    python benchmark.py fundo_branco    # roda só os indicados
+"""
+
+import io
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+from PIL import Image, ImageChops, ImageDraw
+
+import main
+
+logging.getLogger(main.__name__).setLevel(logging.WARNING)
+
+
+# ================================
+# UTILITÁRIOS
+# ================================
+def gerar_imagem_produto(w, h, modo='RGB', seed=0):
+    """Foto sintética de produto: fundo branco com ruído leve e um frasco colorido."""
+    rnd = random.Random(seed)
+    img = Image.new('RGB', (w, h), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for _ in range((w * h) // 400):
+        x, y = rnd.randrange(w), rnd.randrange(h)
+        c = rnd.randint(200, 255)
+        draw.point((x, y), fill=(c, c, c))
+    draw.rounded_rectangle((w * 0.3, h * 0.15, w * 0.7, h * 0.9), radius=max(1, w // 20), fill=(180, 90, 40))
+    draw.ellipse((w * 0.38, h * 0.05, w * 0.62, h * 0.2), fill=(40, 40, 40))
+    if modo != 'RGB':
+        img = img.convert(modo)
+    return img
+
+
+def cronometrar(fn, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        fn()
+    return (time.perf_counter() - inicio) / repeticoes
+
+
+def relatar(nome, antes, depois, unidade='ms'):
+    escala = {'ms': 1e3, 'us': 1e6}[unidade]
+    print(f"  {nome:<28} antes {antes * escala:9.2f} {unidade} | depois {depois * escala:9.2f} {unidade} | {antes / depois:6.1f}x")
+
+
+# ================================
+# VALIDAÇÃO DE FUNDO BRANCO
+# ================================
+def validar_fundo_branco_getpixel(img):
+    """Implementação original, pixel a pixel com getpixel."""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width, height = img.size
+    pixels_brancos = 0
+    pixels_amostrados = 0
+    border_size = min(width, height) // 10
+    for x in range(0, width, 5):
+        for y in range(border_size):
+            r, g, b = img.getpixel((x, y))
+            if r > 240 and g > 240 and b > 240:
+                pixels_brancos += 1
+            pixels_amostrados += 1
+    for x in range(0, width, 5):
+        for y in range(height - border_size, height):
+            r, g, b = img.getpixel((x, y))
+            if r > 240 and g > 240 and b > 240:
+                pixels_brancos += 1
+            pixels_amostrados += 1
+    for y in range(0, height, 5):
+        for x in range(border_size):
+            r, g, b = img.getpixel((x, y))
+            if r > 240 and g > 240 and b > 240:
+                pixels_brancos += 1
+            pixels_amostrados += 1
+        for x in range(width - border_size, width):
+            r, g, b = img.getpixel((x, y))
+            if r > 240 and g > 240 and b > 240:
+                pixels_brancos += 1
+            pixels_amostrados += 1
+    if pixels_amostrados > 0:
+        percentual = (pixels_brancos / pixels_amostrados) * 100
+        return percentual >= 60.0, percentual
+    return False, 0.0
+
+
+def bench_fundo_branco():
+    processador = main.ProcessadorSorteioV5()
+    casos = [
+        ((2000, 2000), 'RGB'),
+        ((1500, 1000), 'RGB'),
+        ((1003, 797), 'RGBA'),
+        ((640, 480), 'P'),
+        ((9, 9), 'RGB'),
+    ]
+    for tamanho, modo in casos:
+        img = gerar_imagem_produto(*tamanho, modo=modo, seed=tamanho[0])
+        esperado = validar_fundo_branco_getpixel(img)
+        obtido = processador.validar_fundo_branco(img)
+        assert obtido == esperado, f"{tamanho} {modo}: {obtido} != {esperado}"
+        repeticoes = 3 if tamanho[0] >= 1500 else 10
+        antes = cronometrar(lambda: validar_fundo_branco_getpixel(img), repeticoes)
+        depois = cronometrar(lambda: processador.validar_fundo_branco(img), repeticoes)
+        relatar(f"{tamanho[0]}x{tamanho[1]} {modo}", antes, depois)
+
+
+# ================================
+# RECORTE COMPARTILHADO (PRODUTO PREPARADO)
+# ================================
+RENDERIZADORES = (
+    'processar_imagem_sorteio',
+    'processar_imagem_vertical_1080x1920',
+    'processar_imagem_vertical_1080x1920_mascarada',
+    'processar_imagem_vertical_1080x1920_teaser_q',
+)
+
+
+def cronometrar_cpu(fn, repeticoes):
+    inicio = time.process_time()
+    for _ in range(repeticoes):
+        fn()
+    return (time.process_time() - inicio) / repeticoes
+
+
+def bench_produto_preparado():
+    processador = main.ProcessadorSorteioV5()
+    verticais = RENDERIZADORES[1:]
+    for tamanho in ((2000, 2000), (1200, 1600)):
+        img = gerar_imagem_produto(*tamanho, seed=tamanho[1])
+
+        def recorte_por_layout():
+            for _ in verticais:
+                produto = main.ProdutoPreparado(img, processador.DIFF_T)
+                produto.redimensionar(produto.escala_caixa())
+
+        def recorte_unico():
+            produto = main.ProdutoPreparado(img, processador.DIFF_T)
+            for _ in verticais:
+                produto.redimensionar(produto.escala_caixa())
+
+        def render_por_layout():
+            for nome in RENDERIZADORES:
+                getattr(processador, nome)(img.copy())
+
+        def render_unico():
+            produto = processador.preparar_produto(img)
+            for nome in RENDERIZADORES:
+                getattr(processador, nome)(produto)
+
+        for nome in RENDERIZADORES:
+            a = getattr(processador, nome)(img.copy())[0].getvalue()
+            b = getattr(processador, nome)(processador.preparar_produto(img))[0].getvalue()
+            assert a == b, f"{nome}: saída difere com produto preparado"
+
+        relatar(f"recorte {tamanho[0]}x{tamanho[1]} (CPU)",
+                cronometrar_cpu(recorte_por_layout, 3), cronometrar_cpu(recorte_unico, 3))
+        relatar(f"produto {tamanho[0]}x{tamanho[1]} (CPU)",
+                cronometrar_cpu(render_por_layout, 2), cronometrar_cpu(render_unico, 2))
+
+
+# ================================
+# EXTRAÇÃO DE CANDIDATAS DO HTML
+# ================================
+def extrair_candidatas_bs4(html_text, url, codigo_produto):
+    """Implementação original, com árvore BeautifulSoup e uma passada por seletor."""
+    soup = BeautifulSoup(html_text, 'html.parser')
+    candidatas = []
+    vistos = set()
+
+    def lixo(u):
+        ul = u.lower()
+        return ('images.rede.natura.net' in ul or 'logo' in ul or 'banner' in ul
+                or '/produtosjoia/background/' in ul or 'bannerjoia' in ul)
+
+    def add_cand(src, motivo, prio):
+        if not src:
+            return
+        if src.startswith('//'):
+            src = 'https:' + src
+        if src.startswith('/'):
+            src = urljoin(url, src)
+        src_clean = (src.split('?')[0] or '').strip()
+        if not src_clean or lixo(src_clean):
+            return
+        if src_clean not in vistos:
+            vistos.add(src_clean)
+            candidatas.append({'url': src_clean, 'score': 0, 'motivo': motivo, 'prio': prio})
+
+    def pick_srcset(val):
+        try:
+            return val.split(',')[-1].strip().split(' ')[0]
+        except Exception:
+            return None
+
+    cdn_patterns = [
+        r'https://production\.na01\.natura\.com/[^\s"\'\)]+/(?:Produtos|produtos)/(?:NATBRA|AVNBRA)-\d+_[1-4]\.(?:jpg|png)',
+        r'https://production\.na01\.natura\.com/[^\s"\'\)]+/(?:NATBRA|AVNBRA)-\d+_[1-4]\.(?:jpg|png)'
+    ]
+    for pat in cdn_patterns:
+        for m in re.findall(pat, html_text):
+            add_cand(m, 'regex CDN', 0)
+    for img in soup.find_all('img'):
+        for attr in ('src', 'data-src', 'data-lazy-src', 'data-original', 'data-image'):
+            v = img.get(attr)
+            if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
+                add_cand(v, f'Contém código {codigo_produto}', 1)
+        for attr in ('srcset', 'data-srcset'):
+            v = img.get(attr)
+            if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
+                add_cand(pick_srcset(v), f'srcset contém código {codigo_produto}', 1)
+    for source in soup.find_all('source'):
+        v = source.get('srcset') or source.get('data-srcset')
+        if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
+            add_cand(pick_srcset(v), f'<source> contém código {codigo_produto}', 1)
+    for el in soup.select('[style*="background-image"]'):
+        for m in re.findall(r'url\(([^)]+)\)', el.get('style', '')):
+            m = m.strip('\'" ')
+            if codigo_produto in m or codigo_produto.replace('-', '') in m:
+                add_cand(m, 'background-image contém código', 1)
+    for lk in soup.select('link[rel="preload"][as="image"]'):
+        add_cand(lk.get('href'), 'link preload image', 2)
+    if not candidatas:
+        for s in soup.select('script[type="application/ld+json"]'):
+            try:
+                data = json.loads(s.string or '')
+                img_field = data.get('image')
+                if isinstance(img_field, str):
+                    add_cand(img_field, 'json-ld image', 2)
+                elif isinstance(img_field, list) and img_field:
+                    add_cand(img_field[0], 'json-ld image[0]', 2)
+            except Exception:
+                continue
+    if not candidatas:
+        for sel in ('.product-gallery img', '.swiper-slide img', '.glide__slide img', '[data-testid="thumbnail"] img'):
+            for g in soup.select(sel):
+                add_cand(g.get('src') or g.get('data-src') or pick_srcset(g.get('srcset') or ''), f'galeria {sel}', 3)
+        for source in soup.select('picture source'):
+            add_cand(pick_srcset(source.get('srcset') or ''), 'picture source', 3)
+    if not candidatas:
+        m = soup.find('meta', {'property': 'og:image'}) or soup.find('meta', {'name': 'twitter:image'})
+        add_cand(m.get('content') if m else None, 'meta image', 4)
+    candidatas.sort(key=lambda x: x.get('prio', 99))
+    return candidatas
+
+
+def gerar_pagina_produto(codigo, blocos=200, com_codigo=True, seed=0):
+    """Página sintética no formato das páginas de produto da Natura."""
+    rnd = random.Random(seed)
+    num = codigo.split('-')[1]
+    cdn = 'https://production.na01.natura.com/on/demandware.static/-/Sites-natura-br-storefront-catalog/default'
+    # sem o código do produto, a vitrine também vem de outro host, para exercitar os fallbacks
+    vitrine = cdn if com_codigo else 'https://static.natura.com.br/vitrine'
+    partes = [
+        '<!DOCTYPE html><html><head><title>Produto</title>',
+        '<meta property="og:image" content="https://www.natura.com.br/og/produto.jpg">',
+        '<meta name="twitter:image" content="https://www.natura.com.br/tw/produto.jpg">',
+        f'<link rel="preload" as="image" href="/static/hero-{num}.webp?v=3">' if com_codigo else '',
+        '<script type="application/ld+json">{"@type": "Product", "image": ["https://cdn.natura.com/ld/%s.jpg"]}</script>' % num,
+        '</head><body><header><img src="/static/logo.svg" alt="logo"></header>',
+    ]
+    for i in range(blocos):
+        outro = rnd.randint(100000, 999999)
+        partes.append(
+            f'<div class="card swiper-slide" data-idx="{i}"><a href="/p/NATBRA-{outro}">'
+            f'<img src="{vitrine}/NATBRA-{outro}_1.jpg?sw=300" data-src="//images.example.com/{outro}.jpg" alt="p{i}">'
+            f'<span style="color:#333">Produto {i} &amp; cia</span></a>'
+            f'<div style="background-image: url(\'{cdn}/bg/{outro}.png\')"></div></div>'
+        )
+        if i % 40 == 0:
+            partes.append('<script>window.__dados = {"itens": [1, 2, 3], "html": "<img src=x>"};</script>')
+    if com_codigo:
+        partes += [
+            f'<div class="product-gallery"><picture><source srcset="{cdn}/Produtos/{codigo}_2.png 1x, {cdn}/Produtos/{codigo}_3.png 2x">',
+            f'<img src="{cdn}/Produtos/{codigo}_1.jpg" srcset="{cdn}/{codigo.replace("-", "")}_4.jpg 800w"></picture>',
+            f'<div data-testid="thumbnail" style="background-image:url(&quot;{cdn}/thumb/{codigo}_1.jpg&quot;)"><img data-src="/img/{codigo}-mini.jpg"></div>',
+            '</div>',
+        ]
+    else:
+        partes.append('<div class="product-gallery"><img src="/galeria/principal.jpg"><picture><source srcset="/p/a.jpg 1x, /p/b.jpg 2x"></picture></div>')
+    partes.append('<footer><img src="/static/banner-rodape.jpg"></footer></body></html>')
+    return ''.join(partes)
+
+
+def bench_extracao_html():
+    processador = main.ProcessadorSorteioV5()
+    url = 'https://www.natura.com.br/p/produto/NATBRA-123456'
+    paginas = []
+    for caminho in filter(None, os.environ.get('BENCH_PAGINAS', '').split(os.pathsep)):
+        with open(caminho, encoding='utf-8', errors='replace') as f:
+            html_text = f.read()
+        codigo = processador.extrair_codigo_produto(caminho) or 'NATBRA-123456'
+        paginas.append((os.path.basename(caminho), html_text, codigo))
+    if not paginas:
+        paginas = [
+            ('200 blocos', gerar_pagina_produto('NATBRA-123456'), 'NATBRA-123456'),
+            ('1000 blocos', gerar_pagina_produto('NATBRA-123456', blocos=1000, seed=1), 'NATBRA-123456'),
+            ('ld+json', gerar_pagina_produto('NATBRA-123456', com_codigo=False, seed=2), 'NATBRA-123456'),
+            ('galeria', gerar_pagina_produto('NATBRA-123456', com_codigo=False, seed=3)
+             .replace('application/ld+json', 'text/plain'), 'NATBRA-123456'),
+            ('meta', gerar_pagina_produto('NATBRA-123456', com_codigo=False, seed=4)
+             .replace('application/ld+json', 'text/plain').replace('product-gallery', 'grid')
+             .replace('picture', 'figure').replace('swiper-slide', 'item'), 'NATBRA-123456'),
+        ]
+    for nome, html_text, codigo in paginas:
+        esperado = extrair_candidatas_bs4(html_text, url, codigo)
+        obtido = processador.extrair_candidatas_html(html_text, url, codigo)
+        assert obtido == esperado, f"{nome}: {obtido} != {esperado}"
+        antes = cronometrar(lambda: extrair_candidatas_bs4(html_text, url, codigo), 5)
+        depois = cronometrar(lambda: processador.extrair_candidatas_html(html_text, url, codigo), 5)
+        relatar(f"{nome} ({len(esperado)} cand.)", antes, depois)
+
+
+# ================================
+# DETECÇÃO DE AUTOMAÇÃO (INTENÇÃO)
+# ================================
+def detectar_automacao_substring(message, automacoes=main.AUTOMACOES_PADRAO):
+    """Versão anterior: busca de substring de cada palavra-chave, categoria por categoria."""
+    message_lower = message.lower()
+    scores = {}
+    for tipo, palavras in automacoes.items():
+        score = 0
+        for palavra in palavras:
+            if palavra in message_lower:
+                score += 1
+        if score > 0:
+            scores[tipo] = score
+    if scores:
+        return max(scores, key=scores.get)
+    return None
+
+
+MENSAGENS_AMOSTRA = [
+    "Oi, tudo bem?", "Quero participar do sorteio!!", "como faço pra participar do sorteio",
+    "Qual o preço desse perfume?", "vcs tem o catálogo novo?", "Quando chega meu pedido?",
+    "meu pedido ainda não chegou, qual o prazo de entrega?", "Preciso de ajuda", "quero falar com atendente",
+    "Quero comprar o creme de mãos", "ganhei o sorteio? 😍", "bom dia", "Obrigada!!",
+    "tem rastreamento pelos correios?", "Qual o valor do Kaiak?", "vocês entregam em Recife?",
+    "quero esse hidratante", "Adoro Natura ❤️", "como adquirir o kit de maquiagem",
+    "o concurso ainda tá valendo?", "quero saber do prêmio", "meu carrinho sumiu", "suporte por favor",
+    "Vocês fazem entrega no mesmo dia?", "Qual a data do próximo sorteio?", "perfume Essencial tem?",
+    "quero conversar com alguém", "Olá! Vi o post no Instagram", "Tem desconto na compra acima de 100?",
+    "Quanto tempo demora a entrega para SP", "vou participar", "Quero!", "esse produto é vegano?",
+    "me passa o contato da consultora", "comprei ontem, quando chega?", "kkkkk", "👏👏👏",
+    "qual o prazo para retirar o prêmio", "Sorteios toda semana?", "Fiz o pedido pelo site e não veio e-mail",
+]
+
+
+def bench_intencao():
+    mensagens = MENSAGENS_AMOSTRA
+    caminho = os.environ.get('BENCH_MENSAGENS')
+    if caminho:
+        with open(caminho, encoding='utf-8', errors='replace') as f:
+            mensagens = [linha.strip() for linha in f if linha.strip()]
+    iguais = sum(1 for m in mensagens if detectar_automacao_substring(m) == main.detectar_automacao(m))
+    repeticoes = max(1, 20000 // len(mensagens))
+    antes = cronometrar(lambda: [detectar_automacao_substring(m) for m in mensagens], repeticoes) / len(mensagens)
+    depois = cronometrar(lambda: [main.detectar_automacao(m) for m in mensagens], repeticoes) / len(mensagens)
+    relatar(f"{len(mensagens)} mensagens (por msg)", antes, depois, 'us')
+    # Diferenças esperadas: a versão nova exige palavra inteira ("quero" não casa em "queroseno")
+    print(f"  mesma categoria em {iguais}/{len(mensagens)} mensagens")
+
+    # Configuração estendida: o custo da busca por substring cresce com o nº de palavras-chave
+    rnd = random.Random(0)
+    automacoes = {tipo: list(palavras) for tipo, palavras in main.AUTOMACOES_PADRAO.items()}
+    for i in range(10):
+        automacoes[f'extra{i}'] = [''.join(rnd.choice('abcdefghijlmnoprstuv') for _ in range(rnd.randint(4, 10)))
+                                   for _ in range(30)]
+    classificador = main.ClassificadorIntencao(automacoes)
+    total = sum(len(p) for p in automacoes.values())
+    antes = cronometrar(lambda: [detectar_automacao_substring(m, automacoes) for m in mensagens], repeticoes) / len(mensagens)
+    depois = cronometrar(lambda: [classificador.classificar(m) for m in mensagens], repeticoes) / len(mensagens)
+    relatar(f"{total} palavras (por msg)", antes, depois, 'us')
+
+
+# ================================
+# LEGENDAS COM CONTORNO (600x600)
+# ================================
+def processar_imagem_sorteio_legado(img_produto):
+    """Versão anterior: TTFs abertos a cada imagem e contorno com 80 + 168 chamadas de draw.text."""
+    from PIL import ImageFont
+    img_produto = img_produto.copy()
+    img_produto.thumbnail((540, 540), Image.Resampling.LANCZOS)
+    canvas = Image.new('RGB', (600, 600), (255, 255, 255))
+    canvas.paste(img_produto, ((600 - img_produto.width) // 2, (600 - img_produto.height) // 2))
+    fonte_media = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
+    fonte_grande = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 96)
+    draw = ImageDraw.Draw(canvas)
+    for texto, fonte, raio, topo in (("Ganhe esse Top!", fonte_media, 4, True), ("Sorteio", fonte_grande, 6, False)):
+        bbox = draw.textbbox((0, 0), texto, font=fonte)
+        x = (600 - (bbox[2] - bbox[0])) // 2
+        y = 20 if topo else 600 - (bbox[3] - bbox[1]) - 20
+        for dx in range(-raio, raio + 1):
+            for dy in range(-raio, raio + 1):
+                if dx != 0 or dy != 0:
+                    draw.text((x + dx, y + dy), texto, font=fonte, fill=(255, 255, 255))
+        draw.text((x, y), texto, font=fonte, fill=(139, 0, 0))
+    buffer = io.BytesIO()
+    canvas.save(buffer, format='PNG', quality=95)
+    buffer.seek(0)
+    return buffer
+
+
+def bench_legendas():
+    processador = main.ProcessadorSorteioV5()
+    img = gerar_imagem_produto(1200, 1600, seed=5)
+    produto = processador.preparar_produto(img)
+    antigo = Image.open(processar_imagem_sorteio_legado(img)).convert('RGB')
+    novo = Image.open(processador.processar_imagem_sorteio(produto)[0]).convert('RGB')
+    diff = ImageChops.difference(antigo, novo).convert('L')
+    diferentes = sum(diff.point(lambda v: 255 if v > 0 else 0).histogram()[255:])
+    # O contorno por dilatação só difere nas bordas suavizadas (antialias) das letras
+    print(f"  pixels diferentes: {diferentes} de {600 * 600} | diferença máxima {diff.getextrema()[1]}")
+    antes = cronometrar(lambda: processar_imagem_sorteio_legado(img), 5)
+    depois = cronometrar(lambda: processador.processar_imagem_sorteio(produto), 5)
+    relatar("600x600 (render + PNG)", antes, depois)
+
+
+# ================================
+# CAMADAS DE SOBREPOSIÇÃO 1080x1920
+# ================================
+def compor_overlay_legado(base_canvas, desenhar, x, y):
+    """Versão anterior: camada redesenhada a cada produto num overlay RGBA da tela inteira e
+    alpha_composite de 1080x1920 (tela convertida para RGBA e de volta para RGB)."""
+    overlay = Image.new('RGBA', base_canvas.size, (0, 0, 0, 0))
+    overlay.paste(desenhar(), (x, y))
+    return Image.alpha_composite(base_canvas.convert('RGBA'), overlay).convert('RGB')
+
+
+def bench_sobreposicoes():
+    processador = main.ProcessadorSorteioV5()
+    produto = processador.preparar_produto(gerar_imagem_produto(1200, 1600, seed=7))
+    img_redim = produto.redimensionar(produto.escala_caixa())
+    canvas_w, canvas_h = main.CANVAS_VERTICAL
+    base = Image.new('RGB', main.CANVAS_VERTICAL, (255, 255, 255))
+    pos_x, pos_y = (canvas_w - img_redim.width) // 2, (canvas_h - img_redim.height) // 2
+    base.paste(img_redim, (pos_x, pos_y))
+
+    card_w = main.quantizar_largura(min(720, int(img_redim.width * 0.7)))
+    _, _, card_h = main.metricas_cartao_mascarado(card_w)
+    diam = int(canvas_w * 0.58)
+    casos = [
+        ("cartão mascarado", lambda: main.camada_cartao_mascarado.__wrapped__(card_w, card_w, card_h),
+         lambda: main.camada_cartao_mascarado(card_w, card_w, card_h),
+         pos_x + img_redim.width // 2 - card_w // 2 - main.MARGEM_CAMADA,
+         pos_y + int(img_redim.height * 0.55) - card_h // 2 - main.MARGEM_CAMADA),
+        ("círculo '?'", lambda: main.camada_circulo_interrogacao.__wrapped__(diam),
+         lambda: main.camada_circulo_interrogacao(diam),
+         canvas_w // 2 - diam // 2 - main.MARGEM_CAMADA,
+         pos_y + img_redim.height // 2 - diam // 2 - main.MARGEM_CAMADA),
+    ]
+    for nome, desenhar, em_cache, x, y in casos:
+        antigo = compor_overlay_legado(base, desenhar, x, y)
+        novo = main.compor_camada(base.copy(), em_cache(), x, y)
+        assert ImageChops.difference(antigo, novo).getbbox() is None, nome
+        antes = cronometrar(lambda: compor_overlay_legado(base, desenhar, x, y), 10)
+        depois = cronometrar(lambda: main.compor_camada(base.copy(), em_cache(), x, y), 10)
+        relatar(nome, antes, depois)
+        area = em_cache().width * em_cache().height
+        print(f"  {'':<28} pixels compostos: {canvas_w * canvas_h} -> {area} ({canvas_w * canvas_h / area:.1f}x menos)")
+
+
+# ================================
+# CODIFICAÇÃO DAS VARIANTES
+# ================================
+def bench_codificacao():
+    processador = main.ProcessadorSorteioV5()
+    produto = processador.preparar_produto(gerar_imagem_produto(1200, 1600, seed=8))
+    tela = Image.open(processador.processar_imagem_vertical_1080x1920_mascarada(produto)[0]).convert('RGB')
+    base = None
+    for especificacao in ('png:nivel=6', 'png:nivel=1', 'png:nivel=3', 'jpeg:q=88,progressivo',
+                          'webp:q=85', 'webp:q=85,metodo=6', 'webp:sem_perda'):
+        codificador = main.CodificadorImagem(especificacao)
+        duracao = cronometrar(lambda: codificador.codificar(tela), 3)
+        tamanho = codificador.codificar(tela)[1]
+        base = base or (duracao, tamanho)
+        print(f"  {especificacao:<28} {duracao * 1000:8.1f} ms | {tamanho / 1024:8.1f} KB "
+              f"| tempo {base[0] / duracao:5.1f}x | tamanho {base[1] / tamanho:5.1f}x")
+
+
+# ================================
+# BACKEND DE RENDERIZAÇÃO (THREADS x PROCESSOS)
+# ================================
+_processador_filho = None
+
+
+def _renderizar_produto_filho(modo, tamanho, dados):
+    """Referência de backend em processos: recebe a imagem uma vez, prepara uma vez e renderiza tudo."""
+    global _processador_filho
+    if _processador_filho is None:
+        logging.getLogger(main.__name__).setLevel(logging.WARNING)
+        _processador_filho = main.ProcessadorSorteioV5()
+    produto = _processador_filho.preparar_produto(Image.frombytes(modo, tamanho, dados))
+    return [buffer.getvalue() if buffer else None
+            for buffer, _ in (getattr(_processador_filho, metodo)(produto) for metodo, _, _ in main.ProcessadorSorteioV5.VARIANTES)]
+
+
+def bench_backend_renderizacao():
+    """Threads (o que main.py usa) contra um pool de processos bem montado, com vários produtos ao
+    mesmo tempo como no cron. O Pillow libera o GIL em resize/filtros/zlib, então as threads já
+    rodam em paralelo; o pool só compensa se superar isso no hardware em questão."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    processador = main.ProcessadorSorteioV5()
+    imagens = [gerar_imagem_produto(1200, 1600, seed=20 + i) for i in range(int(os.environ.get('BENCH_PRODUTOS', '8')))]
+    simultaneos = max(2, os.cpu_count() or 1)
+
+    def renderizar_threads(img):
+        produto = processador.preparar_produto(img)
+        return [buffer.getvalue() if buffer else None
+                for buffer, _ in (getattr(processador, metodo)(produto) for metodo, _, _ in processador.VARIANTES)]
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=simultaneos) as executor:
+        esperado = list(executor.map(renderizar_threads, imagens))
+    antes = time.perf_counter() - inicio
+
+    with ProcessPoolExecutor(max_workers=simultaneos, mp_context=multiprocessing.get_context('spawn')) as pool:
+        list(pool.map(_renderizar_produto_filho, *zip(*[(i.mode, i.size, i.tobytes()) for i in imagens[:simultaneos]])))  # aquece
+        inicio = time.perf_counter()
+        obtido = list(pool.map(_renderizar_produto_filho, *zip(*[(i.mode, i.size, i.tobytes()) for i in imagens])))
+        depois = time.perf_counter() - inicio
+    assert obtido == esperado
+    print(f"  {len(imagens)} produtos, {simultaneos} simultâneos, {os.cpu_count()} CPU(s)")
+    relatar("threads -> processos", antes, depois)
+
+
+# ================================
+# DECODIFICAÇÃO REDUZIDA (PICO DE MEMÓRIA)
+# ================================
+def _memoria_kb(campo):
+    with open('/proc/self/status') as status:
+        return int(re.search(campo + r':\s+(\d+)', status.read()).group(1))
+
+
+def _pico_memoria_produto(caminho, reduzida):
+    """Roda num processo novo: pico de RSS (MB) acima da base para avaliar e renderizar um produto.
+
+    ru_maxrss não serve: é o pico da vida do processo e herda o do pai (fork/exec), então o
+    resultado dependeria do que rodou antes. Aqui o pico (VmHWM) é zerado via clear_refs logo
+    antes da medida.
+    """
+    logging.getLogger(main.__name__).setLevel(logging.WARNING)
+    processador = main.ProcessadorSorteioV5()
+    processador.processar_imagem_sorteio(gerar_imagem_produto(300, 300))  # fontes/sprites fora da medida
+    with open(caminho, 'rb') as arquivo:
+        conteudo = arquivo.read()
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')  # VmHWM passa a ser o RSS atual
+    base = _memoria_kb('VmHWM')
+    inicio = time.perf_counter()
+    if reduzida:
+        img, _ = main.decodificar_reduzida(conteudo)
+    else:
+        img = Image.open(io.BytesIO(conteudo))
+        img.load()
+    processador.validar_fundo_branco(img)
+    produto = processador.preparar_produto(img)
+    if not reduzida:
+        # versão anterior: cópia inteira da base (com o recorte vivo) para a miniatura 600x600
+        copia = produto.original.copy()
+        copia.thumbnail((540, 540), Image.Resampling.LANCZOS)
+        produto._miniaturas[540] = copia
+    for metodo, _, _ in processador.VARIANTES:
+        getattr(processador, metodo)(produto)
+    duracao = time.perf_counter() - inicio
+    return (_memoria_kb('VmHWM') - base) / 1024, duracao
+
+
+def bench_decodificacao_reduzida():
+    import multiprocessing
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    contexto = multiprocessing.get_context('spawn')
+    for w, h in ((2400, 3200), (4000, 6000)):
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as arquivo:
+            gerar_imagem_produto(w, h, seed=30).save(arquivo, format='JPEG', quality=92)
+        try:
+            medidas = []
+            for reduzida in (False, True):
+                with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as executor:
+                    medidas.append(executor.submit(_pico_memoria_produto, arquivo.name, reduzida).result())
+        finally:
+            os.unlink(arquivo.name)
+        (mb_antes, antes), (mb_depois, depois) = medidas
+        print(f"  JPEG {w}x{h}: pico RSS {mb_antes:7.1f} MB -> {mb_depois:7.1f} MB ({mb_antes / max(mb_depois, 0.1):.1f}x)")
+        relatar(f"produto {w}x{h}", antes, depois)
+
+
+BENCHMARKS = {
+    'fundo_branco': bench_fundo_branco,
+    'produto_preparado': bench_produto_preparado,
+    'extracao_html': bench_extracao_html,
+    'intencao': bench_intencao,
+    'legendas': bench_legendas,
+    'sobreposicoes': bench_sobreposicoes,
+    'codificacao': bench_codificacao,
+    'backend_renderizacao': bench_backend_renderizacao,
+    'decodificacao_reduzida': bench_decodificacao_reduzida,
+}
+
+
+if __name__ == '__main__':
+    nomes = sys.argv[1:] or list(BENCHMARKS)
+    for nome in nomes:
+        print(f"▶ {nome}")
+        BENCHMARKS[nome]()
@@ -31,18 +31,35 @@ import threading
 import time
 import logging
 from datetime import datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import json
 import requests
-from bs4 import BeautifulSoup
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageChops
+from html.parser import HTMLParser
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageChops, ImageFile
 import io
+import functools
+import hashlib
+import math
+import random
+import zlib
 import re
-from urllib.parse import urljoin
+import unicodedata
+from urllib.parse import urljoin, urlparse
 import gspread
+from gspread.utils import rowcol_to_a1, ValueInputOption
 from oauth2client.service_account import ServiceAccountCredentials
 import tempfile
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient, Timeout
+from sqlalchemy import create_engine, event, MetaData, Table, Column, String, Float, LargeBinary, Text, Index, select, update, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -55,147 +72,915 @@ CORS(app)
 # ================================
 PLANILHA_ID = "1D84AsjVlCeXmW2hJEIVKBj6EHWe4xYfB6wd-JpHf_Ug"
 
+# Download/avaliação das imagens candidatas de um produto
+AVALIACAO_WORKERS = int(os.getenv('AVALIACAO_WORKERS', '4'))
+AVALIACAO_PRAZO_SEGUNDOS = float(os.getenv('AVALIACAO_PRAZO_SEGUNDOS', '45'))
+# Sondagem do cabeçalho: bytes lidos no máximo e menor lado aceito (abaixo disso é miniatura)
+SONDAGEM_BYTES = int(os.getenv('SONDAGEM_BYTES', '65536'))
+IMG_MIN_LADO = int(os.getenv('IMG_MIN_LADO', '200'))
+# Decodificação reduzida: imagens muito maiores que a caixa 800x1812 são decodificadas já
+# reduzidas (draft no JPEG, reduce nos demais), mantendo pelo menos FOLGA vezes o necessário
+DECODIFICACAO_REDUZIDA = os.getenv('DECODIFICACAO_REDUZIDA', 'true').lower() in ('1', 'true', 'sim')
+DECODIFICACAO_FOLGA = float(os.getenv('DECODIFICACAO_FOLGA', '2'))
+# Uploads simultâneos das variantes de um produto para o Catbox
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+# Produtos processados em paralelo por execução da planilha
+PROCESSAMENTO_WORKERS = int(os.getenv('PROCESSAMENTO_WORKERS', '3'))
+# Escritas na planilha acumuladas e enviadas num único batch_update a cada N linhas ou janela de tempo
+SHEETS_LOTE_LINHAS = int(os.getenv('SHEETS_LOTE_LINHAS', '20'))
+SHEETS_LOTE_SEGUNDOS = float(os.getenv('SHEETS_LOTE_SEGUNDOS', '30'))
+# Cache persistente das URLs já geradas (SQLite), por código do produto e hash da imagem de origem
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', os.path.join(tempfile.gettempdir(), 'processador_cache.sqlite'))
+CACHE_IMAGENS_TTL_HORAS = float(os.getenv('CACHE_IMAGENS_TTL_HORAS', '168'))
+CACHE_IMAGENS_MAX = int(os.getenv('CACHE_IMAGENS_MAX', '5000'))
+# Cache HTTP das páginas de produto (ETag/Last-Modified), no mesmo arquivo SQLite
+CACHE_PAGINAS_MAX = int(os.getenv('CACHE_PAGINAS_MAX', '2000'))
+# Limite por host (requisições/segundo e rajada); 0 desliga
+TAXA_POR_HOST = float(os.getenv('TAXA_POR_HOST', '4'))
+RAJADA_POR_HOST = int(os.getenv('RAJADA_POR_HOST', '4'))
+# Largura do cartão da variante mascarada arredondada para baixo a múltiplos deste valor, para
+# reaproveitar a camada em cache entre produtos; 1 mantém a largura exata
+OVERLAY_QUANTIZACAO_PX = int(os.getenv('OVERLAY_QUANTIZACAO_PX', '8'))
+# Codificação das variantes: "formato[:opções]", ex. "png:nivel=3", "jpeg:q=88,progressivo",
+# "webp:q=85,metodo=4" ou "webp:sem_perda". CODIFICACAO_<ARQUIVO> (ex. CODIFICACAO_SORTEIO_600)
+# sobrepõe o padrão para uma variante
+CODIFICACAO_PADRAO = os.getenv('CODIFICACAO_PADRAO', 'png:nivel=6')
+# Webhook ManyChat assíncrono: responde na hora e entrega a resposta do assistente via API/callback
+MANYCHAT_ASSINCRONO = os.getenv('MANYCHAT_ASSINCRONO', 'false').lower() in ('1', 'true', 'sim')
+MANYCHAT_API_TOKEN = os.getenv('MANYCHAT_API_TOKEN', '')
+MANYCHAT_SEND_CONTENT_URL = 'https://api.manychat.com/fb/sending/sendContent'
+MANYCHAT_CALLBACK_URL = os.getenv('MANYCHAT_CALLBACK_URL', MANYCHAT_SEND_CONTENT_URL)
+# callback_url enviada no payload só é aceita se estiver nesta lista (separada por vírgulas)
+# ou for a própria MANYCHAT_CALLBACK_URL; qualquer outra é ignorada
+MANYCHAT_CALLBACKS_PERMITIDOS = {MANYCHAT_CALLBACK_URL} | {
+    url.strip() for url in os.getenv('MANYCHAT_CALLBACKS_PERMITIDOS', '').split(',') if url.strip()}
+MANYCHAT_WORKERS = int(os.getenv('MANYCHAT_WORKERS', '4'))
+MANYCHAT_CALLBACK_TENTATIVAS = int(os.getenv('MANYCHAT_CALLBACK_TENTATIVAS', '3'))
+# Mensagens do mesmo usuário dentro da janela viram um único run (a janela se estende a cada
+# mensagem nova, até o máximo); as que chegam durante o run viram o lote seguinte, respondido
+# pela mesma requisição líder. 0 desliga o agrupamento
+MANYCHAT_JANELA_SEGUNDOS = float(os.getenv('MANYCHAT_JANELA_SEGUNDOS', '1.5'))
+MANYCHAT_JANELA_MAXIMA_SEGUNDOS = float(os.getenv('MANYCHAT_JANELA_MAXIMA_SEGUNDOS', '6'))
+# JSON opcional com palavras-chave extras por categoria de automação
+AUTOMACOES_ARQUIVO = os.getenv('AUTOMACOES_ARQUIVO', '')
+# Respostas rápidas: JSON {"categoria": "texto com {nome}"} respondido localmente quando a intenção
+# é clara, e cache das respostas do assistente para perguntas repetidas das categorias de FAQ
+FAQ_ARQUIVO = os.getenv('FAQ_ARQUIVO', '')
+FAQ_SCORE_MINIMO = int(os.getenv('FAQ_SCORE_MINIMO', '2'))
+FAQ_CATEGORIAS_CACHE = [c.strip() for c in os.getenv('FAQ_CATEGORIAS_CACHE', 'sorteio,entrega,contato').split(',') if c.strip()]
+FAQ_CACHE_TTL_SEGUNDOS = float(os.getenv('FAQ_CACHE_TTL_SEGUNDOS', '3600'))
+FAQ_CACHE_MAX = int(os.getenv('FAQ_CACHE_MAX', '500'))
+# Espera dos runs do assistente: stream de eventos do SDK ou polling com backoff exponencial + jitter
+ASSISTENTE_STREAM = os.getenv('ASSISTENTE_STREAM', 'true').lower() in ('1', 'true', 'sim')
+ASSISTENTE_PRAZO_SEGUNDOS = float(os.getenv('ASSISTENTE_PRAZO_SEGUNDOS', '30'))
+ASSISTENTE_POLL_INICIAL = float(os.getenv('ASSISTENTE_POLL_INICIAL', '0.25'))
+ASSISTENTE_POLL_MAXIMO = float(os.getenv('ASSISTENTE_POLL_MAXIMO', '2'))
+# Cliente OpenAI único por processo: pool keep-alive, timeouts e tentativas
+OPENAI_MAX_CONEXOES = int(os.getenv('OPENAI_MAX_CONEXOES', '20'))
+OPENAI_CONEXOES_KEEPALIVE = int(os.getenv('OPENAI_CONEXOES_KEEPALIVE', '10'))
+OPENAI_KEEPALIVE_SEGUNDOS = float(os.getenv('OPENAI_KEEPALIVE_SEGUNDOS', '60'))
+OPENAI_TIMEOUT_SEGUNDOS = float(os.getenv('OPENAI_TIMEOUT_SEGUNDOS', '30'))
+OPENAI_TIMEOUT_CONEXAO = float(os.getenv('OPENAI_TIMEOUT_CONEXAO', '5'))
+OPENAI_MAX_TENTATIVAS = int(os.getenv('OPENAI_MAX_TENTATIVAS', '2'))
+# Registro de conversas: 'memoria' (por processo) ou 'sqlite' (compartilhado entre workers e reinícios)
+CONVERSAS_BACKEND = os.getenv('CONVERSAS_BACKEND', 'memoria').lower()
+CONVERSAS_DB_PATH = os.getenv('CONVERSAS_DB_PATH', CACHE_DB_PATH)
+CONVERSAS_TRAVAS_DIR = os.getenv('CONVERSAS_TRAVAS_DIR', os.path.join(tempfile.gettempdir(), 'processador_conversas_travas'))
+# Número fixo de arquivos de trava; cada usuário cai sempre na mesma faixa
+CONVERSAS_TRAVAS_FAIXAS = max(1, int(os.getenv('CONVERSAS_TRAVAS_FAIXAS', '256')))
+CONVERSAS_CACHE_SEGUNDOS = float(os.getenv('CONVERSAS_CACHE_SEGUNDOS', '5'))
+# Espera máxima pela vez do usuário (um run por thread de cada vez)
+CONVERSAS_TRAVA_SEGUNDOS = float(os.getenv('CONVERSAS_TRAVA_SEGUNDOS', '90'))
+
 sistema_status = {
     "ultima_execucao": None,
     "produtos_processados": 0,
     "erros": 0,
+    "falha_planilha": None,
     "status": "Serviço web online. Aguardando execução do Cron Job."
 }
 
 # ================================
 # INTEGRAÇÃO MANYCHAT-CHATGPT
 # ================================
+def conexoes_pool_httpx(http_client):
+    # Lista "ociosa?" por conexão do pool. O httpx/httpcore não expõe isso publicamente, então é
+    # melhor esforço: None se a estrutura interna não for a esperada
+    try:
+        return [conexao.is_idle() for conexao in http_client._transport._pool.connections]
+    except AttributeError:
+        return None
+
+class GerenciadorClienteOpenAI:
+    # Um único OpenAI por processo, criado sob lock na primeira mensagem e reaproveitado por
+    # todas as threads do Flask/executores: as conexões TLS ficam vivas no pool entre mensagens.
+    # Os hooks do cliente HTTP contam requisições e respostas de erro para as estatísticas.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cliente = None
+        self._http_client = None
+        self._api_key = None
+        self._stats = {"clientes_criados": 0, "requisicoes": 0, "respostas_erro": 0}
+
+    def _antes_requisicao(self, request):
+        with self._lock:
+            self._stats["requisicoes"] += 1
+
+    def _depois_resposta(self, response):
+        if response.status_code >= 400:
+            with self._lock:
+                self._stats["respostas_erro"] += 1
+
+    def _criar(self, api_key):
+        limites = httpx.Limits(max_connections=OPENAI_MAX_CONEXOES,
+                               max_keepalive_connections=OPENAI_CONEXOES_KEEPALIVE,
+                               keepalive_expiry=OPENAI_KEEPALIVE_SEGUNDOS)
+        http_client = DefaultHttpxClient(limits=limites,
+                                         event_hooks={"request": [self._antes_requisicao],
+                                                      "response": [self._depois_resposta]})
+        self._http_client = http_client
+        return OpenAI(api_key=api_key, http_client=http_client, max_retries=OPENAI_MAX_TENTATIVAS,
+                      timeout=Timeout(OPENAI_TIMEOUT_SEGUNDOS, connect=OPENAI_TIMEOUT_CONEXAO))
+
+    def obter(self):
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY não configurada")
+        cliente = self._cliente
+        if cliente is not None and self._api_key == api_key:
+            return cliente
+        with self._lock:
+            if self._cliente is None or self._api_key != api_key:
+                antigo = self._cliente
+                self._cliente = self._criar(api_key)
+                self._api_key = api_key
+                self._stats["clientes_criados"] += 1
+                logger.info("🔌 Cliente OpenAI criado (pool de conexões compartilhado)")
+                if antigo is not None:
+                    try:
+                        antigo.close()
+                    except Exception:
+                        pass
+            return self._cliente
+
+    def _uso_pool(self):
+        conexoes = conexoes_pool_httpx(self._http_client)
+        if conexoes is None:
+            return {"conexoes_abertas": None, "conexoes_ocupadas": None}
+        return {"conexoes_abertas": len(conexoes), "conexoes_ocupadas": sum(1 for ociosa in conexoes if not ociosa)}
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+        if self._cliente is not None:
+            stats.update(self._uso_pool())
+        stats.update({
+            "max_conexoes": OPENAI_MAX_CONEXOES,
+            "max_keepalive": OPENAI_CONEXOES_KEEPALIVE,
+            "max_tentativas": OPENAI_MAX_TENTATIVAS
+        })
+        return stats
+
+gerenciador_openai = GerenciadorClienteOpenAI()
+
 def get_openai_client():
-    api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY não configurada")
-    return OpenAI(api_key=api_key)
+    return gerenciador_openai.obter()
 
-user_conversations = {}
 ASSISTANT_ID = "asst_AQjafiLKeePeACy6mzPX1Mqo"
 MAX_CONVERSAS = 1000
 TIMEOUT_CONVERSA = 1800  # 30 min
 
+class TravasPorUsuario:
+    # Um Lock por user_id, criado sob demanda e descartado quando ninguém mais o espera
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._travas = {}
+
+    @contextmanager
+    def bloquear(self, user_id, prazo):
+        with self._lock:
+            item = self._travas.setdefault(user_id, [threading.Lock(), 0])
+            item[1] += 1
+        try:
+            if not item[0].acquire(timeout=prazo):
+                raise TimeoutError(f"Conversa de {user_id} ocupada há mais de {prazo}s")
+            try:
+                yield
+            finally:
+                item[0].release()
+        finally:
+            with self._lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    self._travas.pop(user_id, None)
+
+class ArmazemConversas:
+    # user_id -> thread do assistente. O OrderedDict fica em ordem de última atividade (cada
+    # acesso move a conversa para o fim), então as expiradas estão sempre no início: a expiração
+    # só olha a frente da fila e para na primeira conversa viva, e o excesso sobre `max_conversas`
+    # sai pelo mesmo lado (LRU). Todas as operações são O(1) amortizado e protegidas por lock.
+    def __init__(self, max_conversas, timeout):
+        self.max_conversas = max(1, max_conversas)
+        self.timeout = timeout
+        self._conversas = OrderedDict()
+        self._lock = threading.Lock()
+        self._removidas_ttl = 0
+        self._removidas_lru = 0
+        self._travas = TravasPorUsuario()
+
+    def bloqueio_usuario(self, user_id, prazo=CONVERSAS_TRAVA_SEGUNDOS):
+        # Serializa o processamento de um mesmo usuário: só um run por thread de cada vez
+        return self._travas.bloquear(user_id, prazo)
+
+    def _expirar(self, agora):
+        while self._conversas:
+            user_id, conversa = next(iter(self._conversas.items()))
+            if agora - conversa['last_activity'] <= self.timeout:
+                break
+            self._conversas.popitem(last=False)
+            self._removidas_ttl += 1
+            logger.info(f"🧹 Conversa expirada removida: {user_id}")
+
+    def obter_thread(self, user_id):
+        # thread_id da conversa viva do usuário (renovando a atividade) ou None
+        agora = time.time()
+        with self._lock:
+            self._expirar(agora)
+            conversa = self._conversas.get(user_id)
+            if conversa is None:
+                return None
+            conversa['last_activity'] = agora
+            self._conversas.move_to_end(user_id)
+            return conversa['thread_id']
+
+    def registrar(self, user_id, thread_id):
+        # Guarda a thread nova; se outra requisição registrou antes, mantém a existente e a devolve
+        agora = time.time()
+        with self._lock:
+            self._expirar(agora)
+            conversa = self._conversas.get(user_id)
+            if conversa is None:
+                conversa = {'thread_id': thread_id, 'last_activity': agora}
+                self._conversas[user_id] = conversa
+                while len(self._conversas) > self.max_conversas:
+                    removido, _ = self._conversas.popitem(last=False)
+                    self._removidas_lru += 1
+                    logger.info(f"🧹 Conversa removida por limite ({self.max_conversas}): {removido}")
+            else:
+                conversa['last_activity'] = agora
+            self._conversas.move_to_end(user_id)
+            return conversa['thread_id']
+
+    def remover(self, user_id):
+        with self._lock:
+            return self._conversas.pop(user_id, None) is not None
+
+    def limpar_expiradas(self):
+        with self._lock:
+            self._expirar(time.time())
+
+    def __len__(self):
+        with self._lock:
+            self._expirar(time.time())
+            return len(self._conversas)
+
+    def estatisticas(self):
+        with self._lock:
+            self._expirar(time.time())
+            return {"backend": "memoria", "conversas": len(self._conversas),
+                    "removidas_ttl": self._removidas_ttl, "removidas_lru": self._removidas_lru}
+
 def limpar_conversas_antigas():
-    agora = time.time()
-    usuarios_para_remover = []
-    for user_id, conversa in user_conversations.items():
-        if agora - conversa['last_activity'] > TIMEOUT_CONVERSA:
-            usuarios_para_remover.append(user_id)
-    for user_id in usuarios_para_remover:
-        del user_conversations[user_id]
-        logger.info(f"🧹 Conversa removida por timeout: {user_id}")
+    armazem_conversas.limpar_expiradas()
+
+AUTOMACOES_PADRAO = {
+    'sorteio': ['sorteio', 'concurso', 'prêmio', 'ganhar', 'participar', 'sorteios'],
+    'produto': ['produto', 'natura', 'catálogo', 'preço', 'perfume', 'maquiagem', 'creme'],
+    'contato': ['contato', 'ajuda', 'suporte', 'atendimento', 'falar', 'conversar'],
+    'pedido': ['pedido', 'compra', 'carrinho', 'quero', 'comprar', 'adquirir'],
+    'entrega': ['entrega', 'prazo', 'rastreamento', 'correios', 'quando chega']
+}
+
+def _tabela_acentos():
+    # Letras latinas acentuadas -> base ASCII; marcas combinantes soltas são descartadas
+    tabela = {cp: None for cp in range(0x300, 0x370)}
+    for cp in range(0xC0, 0x250):
+        base = ''.join(c for c in unicodedata.normalize('NFKD', chr(cp)) if not unicodedata.combining(c))
+        if base != chr(cp) and base.isascii():
+            tabela[cp] = base
+    return tabela
+
+TABELA_ACENTOS = _tabela_acentos()
+
+def dobrar_acentos(texto):
+    # minúsculas e sem acentos: "Catálogo" -> "catalogo"
+    texto = texto.lower()
+    return texto if texto.isascii() else texto.translate(TABELA_ACENTOS)
+
+def _padrao_trie(palavras):
+    # Alternação em forma de trie (prefixos comuns fatorados), bem mais barata para o re que
+    # uma lista plana de alternativas; espaços dentro da palavra-chave aceitam qualquer espaço
+    trie = {}
+    for palavra in palavras:
+        no = trie
+        for c in palavra:
+            no = no.setdefault(c, {})
+        no[''] = {}
+
+    def emitir(no):
+        fim = '' in no
+        ramos = [(r'\s+' if c == ' ' else re.escape(c)) + emitir(filho) for c, filho in sorted(no.items()) if c]
+        if not ramos:
+            return ''
+        corpo = ramos[0] if len(ramos) == 1 and not fim else '(?:' + '|'.join(ramos) + ')'
+        return corpo + ('?' if fim else '')
+
+    return emitir(trie)
+
+def carregar_automacoes(caminho=AUTOMACOES_ARQUIVO):
+    # Palavras-chave padrão + as do JSON {"categoria": ["palavra", ...]} (categorias novas vão para o fim)
+    automacoes = {tipo: list(palavras) for tipo, palavras in AUTOMACOES_PADRAO.items()}
+    if caminho:
+        try:
+            with open(caminho, encoding='utf-8') as f:
+                extras = json.load(f)
+            for tipo, palavras in extras.items():
+                automacoes.setdefault(tipo, []).extend(p for p in palavras if p not in automacoes[tipo])
+            logger.info(f"📚 Automações carregadas de {caminho}: {list(extras)}")
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível carregar automações de {caminho}: {e}")
+    return automacoes
+
+class ClassificadorIntencao:
+    # Todas as palavras-chave numa única regex (trie) com fronteira de palavra, aplicada ao texto
+    # sem acentos: uma varredura por mensagem, com custo que quase não cresce com o nº de palavras.
+    # Plural simples (s/es) conta como a palavra. A pontuação é o número de palavras distintas de
+    # cada categoria; no empate vence a categoria que vem primeiro na configuração, como no max()
+    # sobre o dict da versão antiga.
+    def __init__(self, automacoes):
+        self.categorias = list(automacoes)
+        self._palavra_categorias = {}
+        for tipo, palavras in automacoes.items():
+            for palavra in palavras:
+                chave = ' '.join(dobrar_acentos(palavra).split())
+                if chave:
+                    self._palavra_categorias.setdefault(chave, []).append(tipo)
+        padrao = _padrao_trie(self._palavra_categorias)
+        self.regex = re.compile(rf'\b({padrao})(?:e?s)?\b') if padrao else None
+
+    def pontuar(self, message):
+        encontradas = {}
+        if self.regex is None or not message:
+            return encontradas
+        for trecho in self.regex.findall(dobrar_acentos(message)):
+            chave = trecho if trecho in self._palavra_categorias else ' '.join(trecho.split())
+            for tipo in self._palavra_categorias[chave]:
+                encontradas.setdefault(tipo, set()).add(chave)
+        return {tipo: len(encontradas[tipo]) for tipo in self.categorias if tipo in encontradas}
+
+    @staticmethod
+    def escolher(scores):
+        if scores:
+            return max(scores, key=scores.get)
+        return None
+
+    def classificar(self, message):
+        return self.escolher(self.pontuar(message))
+
+classificador_intencao = ClassificadorIntencao(carregar_automacoes())
 
 def detectar_automacao(message):
-    message_lower = message.lower()
-    automacoes = {
-        'sorteio': ['sorteio', 'concurso', 'prêmio', 'ganhar', 'participar', 'sorteios'],
-        'produto': ['produto', 'natura', 'catálogo', 'preço', 'perfume', 'maquiagem', 'creme'],
-        'contato': ['contato', 'ajuda', 'suporte', 'atendimento', 'falar', 'conversar'],
-        'pedido': ['pedido', 'compra', 'carrinho', 'quero', 'comprar', 'adquirir'],
-        'entrega': ['entrega', 'prazo', 'rastreamento', 'correios', 'quando chega']
+    return classificador_intencao.classificar(message)
+
+def resposta_erro_tecnico(user_name):
+    return f"Desculpe {user_name}, estou com dificuldades técnicas. Tente novamente! 😊"
+
+class RespostasRapidas:
+    # Fica na frente do assistente. (1) Categoria com resposta fixa em `respostas` e intenção
+    # clara (score >= `score_minimo` e sem empate) é respondida na hora. (2) Nas categorias de
+    # `categorias_cache`, a resposta do assistente para uma pergunta curta fica guardada por `ttl`
+    # segundos, indexada pelo texto normalizado, com o nome do usuário trocado por {nome}. Só
+    # entram no cache respostas dadas numa thread nova: com histórico, a resposta depende da
+    # conversa daquele usuário e não serve para os outros.
+    PLACEHOLDER_NOME = '{nome}'
+    MAX_CARACTERES = 160
+    RE_NAO_PALAVRA = re.compile(r'[^\w]+')
+
+    def __init__(self, respostas, score_minimo, categorias_cache, ttl, max_entradas):
+        self.respostas = respostas
+        self.score_minimo = score_minimo
+        self.categorias_cache = set(categorias_cache)
+        self.ttl = ttl
+        self.max_entradas = max(1, max_entradas)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"consultas": 0, "locais": 0, "cache_acertos": 0, "cache_falhas": 0}
+
+    @classmethod
+    def carregar(cls, caminho=FAQ_ARQUIVO):
+        respostas = {}
+        if caminho:
+            try:
+                with open(caminho, encoding='utf-8') as f:
+                    respostas = json.load(f)
+                logger.info(f"📚 Respostas rápidas carregadas de {caminho}: {list(respostas)}")
+            except Exception as e:
+                logger.warning(f"⚠️ Não foi possível carregar respostas rápidas de {caminho}: {e}")
+        return cls(respostas, FAQ_SCORE_MINIMO, FAQ_CATEGORIAS_CACHE, FAQ_CACHE_TTL_SEGUNDOS, FAQ_CACHE_MAX)
+
+    def _chave(self, message):
+        if len(message) > self.MAX_CARACTERES:
+            return None
+        chave = ' '.join(self.RE_NAO_PALAVRA.sub(' ', dobrar_acentos(message)).split())
+        return chave or None
+
+    def _contar(self, chave):
+        with self._lock:
+            self._stats[chave] += 1
+
+    def responder(self, message, user_name, scores):
+        # (resposta, origem) com origem 'local' ou 'cache'; (None, None) se precisa do assistente
+        self._contar("consultas")
+        categoria = ClassificadorIntencao.escolher(scores)
+        if categoria is None:
+            return None, None
+        score = scores[categoria]
+        empate = sum(1 for s in scores.values() if s == score) > 1
+        if categoria in self.respostas and score >= self.score_minimo and not empate:
+            self._contar("locais")
+            return self.respostas[categoria].replace(self.PLACEHOLDER_NOME, user_name), 'local'
+        if categoria not in self.categorias_cache:
+            return None, None
+        chave = self._chave(message)
+        if chave is None:
+            return None, None
+        agora = time.time()
+        with self._lock:
+            item = self._cache.get(chave)
+            if item is not None and agora - item[1] > self.ttl:
+                del self._cache[chave]
+                item = None
+            if item is None:
+                self._stats["cache_falhas"] += 1
+                return None, None
+            self._cache.move_to_end(chave)
+            self._stats["cache_acertos"] += 1
+        return item[0].replace(self.PLACEHOLDER_NOME, user_name), 'cache'
+
+    def guardar(self, message, user_name, scores, resposta):
+        if ClassificadorIntencao.escolher(scores) not in self.categorias_cache:
+            return
+        chave = self._chave(message)
+        if chave is None or not resposta or resposta == resposta_erro_tecnico(user_name):
+            return
+        if not user_name or len(user_name) < 2:
+            return  # nome curto demais para ser isolado no texto: a resposta não pode ser compartilhada
+        # só ocorrências isoladas do nome: "Nat" não pode virar placeholder dentro de "Natura"
+        resposta = re.sub(rf'(?<!\w){re.escape(user_name)}(?!\w)', lambda _: self.PLACEHOLDER_NOME, resposta)
+        with self._lock:
+            self._cache[chave] = (resposta, time.time())
+            self._cache.move_to_end(chave)
+            while len(self._cache) > self.max_entradas:
+                self._cache.popitem(last=False)
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entradas_cache"] = len(self._cache)
+        acertos = stats["locais"] + stats["cache_acertos"]
+        stats["taxa_acerto"] = round(acertos / stats["consultas"], 3) if stats["consultas"] else None
+        stats["categorias_locais"] = sorted(self.respostas)
+        return stats
+
+respostas_rapidas = RespostasRapidas.carregar()
+
+class AguardadorRuns:
+    # Espera a conclusão de runs do Assistants API. Com stream disponível, o run é criado via
+    # runs.stream e a espera termina no evento final; senão (ou se o stream falhar) faz polling
+    # com intervalo crescendo de `intervalo_inicial` até `intervalo_maximo`, com jitter, até o prazo.
+    STATUS_ATIVOS = ('queued', 'in_progress', 'cancelling')
+    EVENTOS_FINAIS = {
+        'thread.run.completed': 'completed', 'thread.run.failed': 'failed',
+        'thread.run.cancelled': 'cancelled', 'thread.run.expired': 'expired',
+        'thread.run.incomplete': 'incomplete', 'thread.run.requires_action': 'requires_action'
     }
-    scores = {}
-    for tipo, palavras in automacoes.items():
-        score = 0
-        for palavra in palavras:
-            if palavra in message_lower:
-                score += 1
-        if score > 0:
-            scores[tipo] = score
-    if scores:
-        return max(scores, key=scores.get)
-    return None
-
-def processar_com_chatgpt(message, user_name, user_id):
+    LIMITES_HISTOGRAMA = (0.5, 1, 2, 4, 8, 16, 32, 60)
+
+    def __init__(self, prazo, intervalo_inicial, intervalo_maximo, usar_stream=True, fator=1.6):
+        self.prazo = prazo
+        self.intervalo_inicial = max(0.01, intervalo_inicial)
+        self.intervalo_maximo = max(self.intervalo_inicial, intervalo_maximo)
+        self.usar_stream = usar_stream
+        self.fator = fator
+        self._lock = threading.Lock()
+        self._histograma = [0] * (len(self.LIMITES_HISTOGRAMA) + 1)
+        self._duracoes = deque(maxlen=500)
+        self._resultados = {}
+        self._modos = {"stream": 0, "polling": 0}
+        self._consultas = 0
+
+    def _registrar(self, duracao, resultado, modo, consultas):
+        with self._lock:
+            faixa = next((i for i, limite in enumerate(self.LIMITES_HISTOGRAMA) if duracao <= limite),
+                         len(self.LIMITES_HISTOGRAMA))
+            self._histograma[faixa] += 1
+            self._duracoes.append(round(duracao, 3))
+            self._resultados[resultado] = self._resultados.get(resultado, 0) + 1
+            self._modos[modo] += 1
+            self._consultas += consultas
+
+    def aguardar(self, client, thread_id, run_id, prazo=None, registrar=True):
+        # Polling com backoff; devolve o status final ou 'timeout' se o prazo acabar
+        inicio = time.monotonic()
+        status, consultas = self._consultar_ate_fim(client, thread_id, run_id, prazo)
+        if registrar:
+            self._registrar(time.monotonic() - inicio, status, "polling", consultas)
+        return status
+
+    def _consultar_ate_fim(self, client, thread_id, run_id, prazo=None):
+        inicio = time.monotonic()
+        limite = inicio + (self.prazo if prazo is None else prazo)
+        intervalo = self.intervalo_inicial
+        consultas = 0
+        while True:
+            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            consultas += 1
+            status = run.status
+            if status not in self.STATUS_ATIVOS:
+                break
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                status = 'timeout'
+                break
+            time.sleep(min(restante, random.uniform(intervalo / 2, intervalo)))
+            intervalo = min(self.intervalo_maximo, intervalo * self.fator)
+        return status, consultas
+
+    def executar(self, client, thread_id, assistant_id):
+        # Cria o run e espera seu fim; devolve (run_id, status)
+        inicio = time.monotonic()
+        runs = client.beta.threads.runs
+        if self.usar_stream and hasattr(runs, 'stream'):
+            run_id = None
+            inicio_relogio = time.time()
+            try:
+                with runs.stream(thread_id=thread_id, assistant_id=assistant_id, timeout=self.prazo) as stream:
+                    for evento in stream:
+                        if run_id is None and evento.event.startswith('thread.run.'):
+                            run_id = evento.data.id
+                        status = self.EVENTOS_FINAIS.get(evento.event)
+                        if status:
+                            self._registrar(time.monotonic() - inicio, status, "stream", 0)
+                            return run_id, status
+                        if time.monotonic() - inicio > self.prazo:
+                            break
+            except Exception as e:
+                logger.warning(f"⚠️ Stream do assistente indisponível, usando polling: {e}")
+                if run_id is None:
+                    # o run pode ter sido criado antes da falha: criar outro seria rejeitado
+                    # (thread com run ativo) ou geraria duas respostas
+                    run_id = self._run_recente(client, thread_id, inicio_relogio)
+            if run_id is not None:
+                restante = self.prazo - (time.monotonic() - inicio)
+                status, consultas = self._consultar_ate_fim(client, thread_id, run_id, prazo=max(0, restante))
+                self._registrar(time.monotonic() - inicio, status, "polling", consultas)
+                return run_id, status
+        run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+        restante = self.prazo - (time.monotonic() - inicio)
+        status, consultas = self._consultar_ate_fim(client, thread_id, run.id, prazo=max(0, restante))
+        self._registrar(time.monotonic() - inicio, status, "polling", consultas)
+        return run.id, status
+
+    def _run_recente(self, client, thread_id, desde):
+        # Run mais recente da thread, se ainda ativo (com a trava do usuário, só pode ser o nosso)
+        # ou criado depois de `desde` (epoch, com folga para diferença de relógio); senão None
+        try:
+            recentes = client.beta.threads.runs.list(thread_id=thread_id, limit=1).data
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível consultar os runs da thread: {e}")
+            return None
+        if recentes and (recentes[0].status in self.STATUS_ATIVOS or recentes[0].created_at >= desde - 2):
+            logger.info(f"🔎 Run {recentes[0].id} criado pelo stream interrompido - acompanhando por polling")
+            return recentes[0].id
+        return None
+
+    def estatisticas(self):
+        with self._lock:
+            duracoes = sorted(self._duracoes)
+            rotulos = [f"<={limite}s" for limite in self.LIMITES_HISTOGRAMA] + [f">{self.LIMITES_HISTOGRAMA[-1]}s"]
+            total = sum(self._histograma)
+            return {
+                "total": total,
+                "histograma_segundos": dict(zip(rotulos, self._histograma)),
+                "p50": _percentil(duracoes, 50),
+                "p90": _percentil(duracoes, 90),
+                "p99": _percentil(duracoes, 99),
+                "resultados": dict(self._resultados),
+                "modos": dict(self._modos),
+                "consultas_por_run": round(self._consultas / total, 2) if total else None
+            }
+
+aguardador_runs = AguardadorRuns(ASSISTENTE_PRAZO_SEGUNDOS, ASSISTENTE_POLL_INICIAL,
+                                 ASSISTENTE_POLL_MAXIMO, usar_stream=ASSISTENTE_STREAM)
+
+def processar_com_chatgpt(message, user_name, user_id, contexto=None):
     try:
         logger.info(f"🤖 Iniciando processamento ChatGPT para {user_name}")
         client = get_openai_client()
-        logger.info("✅ Cliente OpenAI criado")
+        logger.info("✅ Cliente OpenAI pronto")
 
         logger.info(f"🎯 Usando assistente: {ASSISTANT_ID}")
-        global user_conversations
-
-        current_time = time.time()
-        expired_users = [uid for uid, conv in user_conversations.items() 
-                         if current_time - conv.get('last_activity', 0) > 1800]
-        for uid in expired_users:
-            del user_conversations[uid]
-            logger.info(f"🧹 Conversa expirada removida: {uid}")
-
-        if user_id not in user_conversations:
-            logger.info(f"🆕 Criando nova thread para {user_name}")
-            thread = client.beta.threads.create()
-            user_conversations[user_id] = {'thread_id': thread.id, 'last_activity': current_time}
-            logger.info(f"✅ Thread criada: {thread.id}")
-        else:
-            thread_id = user_conversations[user_id]['thread_id']
-            user_conversations[user_id]['last_activity'] = current_time
-            logger.info(f"🔄 Usando thread existente: {thread_id}")
 
-        thread_id = user_conversations[user_id]['thread_id']
-
-        logger.info("🔍 Verificando runs ativos na thread")
+        with armazem_conversas.bloqueio_usuario(user_id):
+            return _executar_assistente(client, message, user_name, user_id, contexto)
+    except Exception as e:
+        logger.error(f"❌ Erro ChatGPT: {e}")
+        return resposta_erro_tecnico(user_name)
+
+def _executar_assistente(client, message, user_name, user_id, contexto=None):
+    # Chamado com a trava do usuário: nenhum outro worker/thread roda na mesma thread agora.
+    # `contexto`, se dado, recebe 'thread_nova' (a resposta não dependeu de histórico).
+    thread_id = armazem_conversas.obter_thread(user_id)
+    thread_nova = thread_id is None
+    if thread_id is None:
+        logger.info(f"🆕 Criando nova thread para {user_name}")
+        thread = client.beta.threads.create()
+        thread_id = armazem_conversas.registrar(user_id, thread.id)
+        thread_nova = thread_id == thread.id
+        logger.info(f"✅ Thread criada: {thread.id}")
+    else:
+        logger.info(f"🔄 Usando thread existente: {thread_id}")
+
+    # Runs deixados por um worker que caiu no meio da resposta
+    logger.info("🔍 Verificando runs ativos na thread")
+    try:
+        active_runs = client.beta.threads.runs.list(thread_id=thread_id, limit=5)
+        for run in active_runs.data:
+            if run.status in ['queued', 'in_progress']:
+                logger.info(f"⏳ Run ativo encontrado: {run.id} (status: {run.status})")
+                status_anterior = aguardador_runs.aguardar(client, thread_id, run.id, registrar=False)
+                if status_anterior != 'timeout':
+                    logger.info(f"✅ Run anterior terminou: {status_anterior}")
+                else:
+                    logger.warning("⚠️ Timeout aguardando run anterior - cancelando")
+                    try:
+                        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                        logger.info("🚫 Run anterior cancelado")
+                    except:
+                        logger.warning("⚠️ Não foi possível cancelar run anterior")
+                break
+        logger.info("✅ Thread livre para nova mensagem")
+    except Exception as e:
+        logger.warning(f"⚠️ Erro verificando runs ativos: {e}")
+
+    logger.info("📝 Adicionando mensagem à thread")
+    client.beta.threads.messages.create(thread_id=thread_id, role="user", content=f"{user_name}: {message}")
+
+    logger.info(f"🚀 Executando assistente {ASSISTANT_ID}")
+    logger.info("⏳ Aguardando resposta do assistente...")
+    run_id, status = aguardador_runs.executar(client, thread_id, ASSISTANT_ID)
+    if status == 'timeout':
+        logger.error("❌ Timeout aguardando assistente")
+        raise Exception("Timeout aguardando resposta do assistente")
+    if status != 'completed':
+        logger.error(f"❌ Assistente falhou: {status}")
+        raise Exception(f"Assistente falhou: {status}")
+    logger.info("✅ Assistente concluído")
+
+    logger.info("📥 Obtendo resposta do assistente")
+    messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
+    if not messages.data:
+        logger.error("❌ Nenhuma resposta encontrada")
+        raise Exception("Nenhuma resposta encontrada")
+
+    resposta = messages.data[0].content[0].text.value
+    logger.info("✅ Resposta recebida do assistente")
+    logger.info(f"✅ Resposta para {user_name}: {resposta[:50]}...")
+    if contexto is not None:
+        contexto['thread_nova'] = thread_nova
+    return resposta
+
+_executor_historico = ThreadPoolExecutor(max_workers=2, thread_name_prefix="historico")
+
+def registrar_no_historico(message, resposta, user_name, user_id):
+    # Respostas rápidas não passam pelo assistente: a troca é acrescentada à thread do usuário
+    # em segundo plano (com a trava dele), para o assistente enxergá-la nas próximas mensagens
+    def registrar():
         try:
-            active_runs = client.beta.threads.runs.list(thread_id=thread_id, limit=5)
-            for run in active_runs.data:
-                if run.status in ['queued', 'in_progress']:
-                    logger.info(f"⏳ Run ativo encontrado: {run.id} (status: {run.status})")
-                    wait_attempts = 30
-                    for attempt in range(wait_attempts):
-                        run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                        if run_status.status not in ['queued', 'in_progress']:
-                            logger.info(f"✅ Run anterior terminou: {run_status.status}")
-                            break
-                        time.sleep(1)
-                    if attempt >= wait_attempts - 1:
-                        logger.warning("⚠️ Timeout aguardando run anterior - cancelando")
-                        try:
-                            client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                            logger.info("🚫 Run anterior cancelado")
-                        except:
-                            logger.warning("⚠️ Não foi possível cancelar run anterior")
-                    break
-            logger.info("✅ Thread livre para nova mensagem")
+            client = get_openai_client()
+            with armazem_conversas.bloqueio_usuario(user_id):
+                thread_id = armazem_conversas.obter_thread(user_id)
+                if thread_id is None:
+                    thread_id = armazem_conversas.registrar(user_id, client.beta.threads.create().id)
+                client.beta.threads.messages.create(thread_id=thread_id, role="user", content=f"{user_name}: {message}")
+                client.beta.threads.messages.create(thread_id=thread_id, role="assistant", content=resposta)
+            logger.info(f"🧾 Resposta rápida registrada no histórico de {user_name}")
         except Exception as e:
-            logger.warning(f"⚠️ Erro verificando runs ativos: {e}")
+            logger.warning(f"⚠️ Não foi possível registrar resposta rápida no histórico de {user_name}: {e}")
+    _executor_historico.submit(registrar)
+
+def montar_resposta_manychat(message, user_name, user_id):
+    logger.info("🔍 Iniciando detecção de automação")
+    scores = classificador_intencao.pontuar(message)
+    tipo_automacao = ClassificadorIntencao.escolher(scores)
+    if tipo_automacao:
+        logger.info(f"🎯 Automação detectada: {tipo_automacao}")
+    else:
+        logger.info("📝 Nenhuma automação específica detectada")
+
+    resposta, origem = respostas_rapidas.responder(message, user_name, scores)
+    if resposta is not None:
+        logger.info(f"⚡ Resposta rápida ({origem}) para {user_name}, sem chamar o assistente")
+        registrar_no_historico(message, resposta, user_name, user_id)
+    else:
+        logger.info("🚀 CHAMANDO FUNÇÃO processar_com_chatgpt")
+        logger.info(f"📋 Parâmetros: message='{message}', user_name='{user_name}', user_id='{user_id}'")
+        try:
+            contexto = {}
+            resposta = processar_com_chatgpt(message, user_name, user_id, contexto)
+            logger.info(f"✅ FUNÇÃO processar_com_chatgpt RETORNOU: {resposta[:50]}...")
+            if contexto.get('thread_nova'):
+                respostas_rapidas.guardar(message, user_name, scores, resposta)
+        except Exception as e:
+            logger.error(f"❌ ERRO NA FUNÇÃO processar_com_chatgpt: {e}")
+            logger.error(f"❌ Tipo do erro: {type(e).__name__}")
+            resposta = resposta_erro_tecnico(user_name)
+
+    if tipo_automacao:
+        resposta += f"\n\n[Automação {tipo_automacao} detectada]"
+        logger.info(f"🏷️ Adicionado indicador de automação: {tipo_automacao}")
+    return resposta
+
+class AgrupadorMensagens:
+    # Junta mensagens seguidas do mesmo usuário num lote. A primeira requisição do lote é a
+    # líder: espera a janela fechar (cada mensagem nova estende a janela até `janela_maxima`
+    # desde a primeira) e faz um único run com o texto de todas. As demais só entram no lote
+    # e retornam na hora, sem esperar o run de ninguém. Mensagens que chegam enquanto o run da
+    # líder ainda está em andamento formam o lote seguinte, que a mesma líder responde ao terminar.
+    def __init__(self, janela, janela_maxima):
+        self.janela = max(0.0, janela)
+        self.janela_maxima = max(self.janela, janela_maxima)
+        self._lock = threading.Lock()
+        self._abertos = {}
+        self._ativos = set()     # usuários com run da líder em andamento
+        self._seguintes = {}     # user_id -> mensagens recebidas durante esse run
+        self._lotes = 0
+        self._agrupadas = 0
+        self._lotes_seguintes = 0
+
+    def adicionar(self, chave, message):
+        # Devolve o lote novo se esta requisição é a líder; None se a mensagem entrou num lote aberto.
+        # chave None (remetente sem identificação) nunca agrupa: o lote é só desta mensagem.
+        agora = time.monotonic()
+        with self._lock:
+            self._lotes += 1
+            if chave is None or self.janela <= 0:
+                return {'chave': None, 'mensagens': [message], 'inicio': agora, 'prazo': agora}
+            lote = self._abertos.get(chave)
+            if lote is not None:
+                lote['mensagens'].append(message)
+                lote['prazo'] = min(lote['inicio'] + self.janela_maxima, agora + self.janela)
+                self._agrupadas += 1
+                self._lotes -= 1
+                return None
+            if chave in self._ativos:
+                if chave not in self._seguintes:
+                    self._seguintes[chave] = []
+                    self._lotes_seguintes += 1
+                self._seguintes[chave].append(message)
+                self._agrupadas += 1
+                self._lotes -= 1
+                return None
+            lote = {'chave': chave, 'mensagens': [message], 'inicio': agora, 'prazo': agora + self.janela}
+            self._abertos[chave] = lote
+            return lote
+
+    def aguardar(self, lote):
+        # Chamado pela líder: dorme até a janela fechar e devolve o texto combinado do lote
+        chave = lote['chave']
+        while True:
+            with self._lock:
+                restante = lote['prazo'] - time.monotonic()
+                if restante <= 0:
+                    if chave is not None and self._abertos.get(chave) is lote:
+                        del self._abertos[chave]
+                        self._ativos.add(chave)
+                    return "\n".join(lote['mensagens'])
+            time.sleep(restante)
+
+    def _proximo(self, chave):
+        # Texto do lote que se formou durante o run da líder, ou None (e a chave deixa de estar ativa)
+        with self._lock:
+            mensagens = self._seguintes.pop(chave, None)
+            if mensagens is None:
+                self._ativos.discard(chave)
+                return None
+            return "\n".join(mensagens)
+
+    def processar(self, lote, responder):
+        # Chamado pela líder: responde o lote com `responder(texto)` e, em seguida, cada lote que
+        # chegou enquanto o anterior era respondido. Devolve os retornos de `responder`, em ordem.
+        message = self.aguardar(lote)
+        chave = lote['chave']
+        if chave is None:
+            return [responder(message)]
+        resultados = []
+        try:
+            while message is not None:
+                resultados.append(responder(message))
+                message = self._proximo(chave)
+        except BaseException:
+            with self._lock:
+                self._ativos.discard(chave)
+                perdidas = self._seguintes.pop(chave, None)
+            if perdidas:
+                logger.error(f"❌ {len(perdidas)} mensagem(ns) de {chave} sem resposta após erro no lote anterior")
+            raise
+        return resultados
+
+    def estatisticas(self):
+        with self._lock:
+            return {"janela_segundos": self.janela, "lotes": self._lotes,
+                    "lotes_seguintes": self._lotes_seguintes, "mensagens_agrupadas": self._agrupadas,
+                    "lotes_abertos": len(self._abertos), "runs_ativos": len(self._ativos)}
+
+agrupador_mensagens = AgrupadorMensagens(MANYCHAT_JANELA_SEGUNDOS, MANYCHAT_JANELA_MAXIMA_SEGUNDOS)
+
+class EntregadorManyChat:
+    # Modo assíncrono do webhook: o run do assistente roda num executor próprio e a resposta
+    # é enviada depois por POST ao endpoint sendContent do ManyChat (ou à callback_url do pedido,
+    # se permitida). Em testes, MANYCHAT_CALLBACK_URL pode apontar para um stub local.
+    def __init__(self, workers, tentativas):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="manychat")
+        self.tentativas = max(1, tentativas)
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._stats = {"agendadas": 0, "pendentes": 0, "entregues": 0, "falhas": 0}
 
-        logger.info("📝 Adicionando mensagem à thread")
-        client.beta.threads.messages.create(thread_id=thread_id, role="user", content=f"{user_name}: {message}")
+    def _contar(self, **deltas):
+        with self._lock:
+            for chave, delta in deltas.items():
+                self._stats[chave] += delta
 
-        logger.info(f"🚀 Executando assistente {ASSISTANT_ID}")
-        run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=ASSISTANT_ID)
+    def agendar(self, lote, user_name, user_id, callback_url=None):
+        self._contar(agendadas=1, pendentes=1)
+        return self.executor.submit(self._processar_e_entregar, lote, user_name,
+                                    user_id, callback_url or MANYCHAT_CALLBACK_URL)
 
-        logger.info("⏳ Aguardando resposta do assistente...")
-        max_attempts = 30
-        attempt = 0
-        while attempt < max_attempts:
-            run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-            if run_status.status == 'completed':
-                logger.info("✅ Assistente concluído")
-                break
-            elif run_status.status in ['failed', 'cancelled', 'expired']:
-                logger.error(f"❌ Assistente falhou: {run_status.status}")
-                raise Exception(f"Assistente falhou: {run_status.status}")
-            time.sleep(1)
-            attempt += 1
-        if attempt >= max_attempts:
-            logger.error("❌ Timeout aguardando assistente")
-            raise Exception("Timeout aguardando resposta do assistente")
-
-        logger.info("📥 Obtendo resposta do assistente")
-        messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
-        if not messages.data:
-            logger.error("❌ Nenhuma resposta encontrada")
-            raise Exception("Nenhuma resposta encontrada")
-
-        resposta = messages.data[0].content[0].text.value
-        logger.info("✅ Resposta recebida do assistente")
-        logger.info(f"✅ Resposta para {user_name}: {resposta[:50]}...")
-        return resposta
-    except Exception as e:
-        logger.error(f"❌ Erro ChatGPT: {e}")
-        return f"Desculpe {user_name}, estou com dificuldades técnicas. Tente novamente! 😊"
+    def _processar_e_entregar(self, lote, user_name, user_id, callback_url):
+        try:
+            entregas = agrupador_mensagens.processar(
+                lote,
+                lambda message: self.entregar(user_id, montar_resposta_manychat(message, user_name, user_id), callback_url))
+            entregue = all(entregas)
+        except Exception as e:
+            logger.error(f"❌ Erro no processamento assíncrono ManyChat: {e}")
+            entregue = False
+        if entregue:
+            self._contar(pendentes=-1, entregues=1)
+        else:
+            self._contar(pendentes=-1, falhas=1)
+        return entregue
+
+    def entregar(self, user_id, texto, callback_url):
+        payload = {
+            "subscriber_id": user_id,
+            "data": {"version": "v2", "content": {"messages": [{"type": "text", "text": texto}]}},
+            "message_tag": "ACCOUNT_UPDATE"
+        }
+        headers = {"Content-Type": "application/json"}
+        # o token só vai para a API oficial, nunca para callbacks de terceiros/stubs
+        if MANYCHAT_API_TOKEN and callback_url == MANYCHAT_SEND_CONTENT_URL:
+            headers["Authorization"] = f"Bearer {MANYCHAT_API_TOKEN}"
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                resp = self.session.post(callback_url, json=payload, headers=headers, timeout=15)
+                if resp.status_code < 400:
+                    logger.info(f"📤 Resposta assíncrona entregue para {user_id}")
+                    return True
+                logger.warning(f"⚠️ Callback ManyChat HTTP {resp.status_code} (tentativa {tentativa}/{self.tentativas})")
+                if 400 <= resp.status_code < 500 and resp.status_code != 429:
+                    break
+            except Exception as e:
+                logger.warning(f"⚠️ Erro no callback ManyChat (tentativa {tentativa}/{self.tentativas}): {e}")
+            if tentativa < self.tentativas:
+                time.sleep(2 ** (tentativa - 1))
+        logger.error(f"❌ Não foi possível entregar resposta assíncrona para {user_id}")
+        return False
+
+    def estatisticas(self):
+        with self._lock:
+            return dict(self._stats)
+
+entregador_manychat = EntregadorManyChat(MANYCHAT_WORKERS, MANYCHAT_CALLBACK_TENTATIVAS)
+
+def valor_booleano(valor, padrao=False):
+    # Campos booleanos do payload podem chegar como bool, número ou texto ("false" não liga nada)
+    if valor is None:
+        return padrao
+    if isinstance(valor, str):
+        return valor.strip().lower() in ('1', 'true', 'sim')
+    return bool(valor)
 
 @app.route('/webhook/manychat', methods=['GET', 'POST'])
 def webhook_manychat():
@@ -226,28 +1011,32 @@ def webhook_manychat():
         if not message:
             return jsonify({"messages": [{"text": "Desculpe, não consegui entender sua mensagem. Pode tentar novamente? 😊"}]})
 
-        logger.info("🔍 Iniciando detecção de automação")
-        tipo_automacao = detectar_automacao(message)
-        if tipo_automacao:
-            logger.info(f"🎯 Automação detectada: {tipo_automacao}")
-        else:
-            logger.info("📝 Nenhuma automação específica detectada")
-
-        logger.info("🚀 CHAMANDO FUNÇÃO processar_com_chatgpt")
-        logger.info(f"📋 Parâmetros: message='{message}', user_name='{user_name}', user_id='{user_id}'")
-        try:
-            resposta = processar_com_chatgpt(message, user_name, user_id)
-            logger.info(f"✅ FUNÇÃO processar_com_chatgpt RETORNOU: {resposta[:50]}...")
-        except Exception as e:
-            logger.error(f"❌ ERRO NA FUNÇÃO processar_com_chatgpt: {e}")
-            logger.error(f"❌ Tipo do erro: {type(e).__name__}")
-            resposta = f"Desculpe {user_name}, estou com dificuldades técnicas. Tente novamente! 😊"
-
-        if tipo_automacao:
-            resposta += f"\n\n[Automação {tipo_automacao} detectada]"
-            logger.info(f"🏷️ Adicionado indicador de automação: {tipo_automacao}")
-
-        response = {"messages": [{"text": resposta}]}
+        # sem user_id não há como saber se duas mensagens são da mesma pessoa: nada de agrupar
+        chave = (platform, user_id) if user_id and user_id != 'unknown' else None
+        lote = agrupador_mensagens.adicionar(chave, message)
+        if lote is None:
+            logger.info(f"🧩 Mensagem de {user_name} agrupada ao lote em andamento - respondida pela requisição líder")
+            return jsonify({"messages": []})
+
+        callback_url = data.get('callback_url')
+        if callback_url and callback_url not in MANYCHAT_CALLBACKS_PERMITIDOS:
+            logger.warning(f"⚠️ callback_url fora da lista permitida ignorada: {callback_url}")
+            callback_url = None
+        assincrono = valor_booleano(data.get('async'), MANYCHAT_ASSINCRONO)
+        # A API oficial do ManyChat exige token; sem ele (e sem stub/callback próprio) não há como entregar
+        if assincrono and not callback_url and not MANYCHAT_API_TOKEN and MANYCHAT_CALLBACK_URL == MANYCHAT_SEND_CONTENT_URL:
+            logger.warning("⚠️ Modo assíncrono sem MANYCHAT_API_TOKEN/callback - respondendo de forma síncrona")
+            assincrono = False
+        if assincrono:
+            entregador_manychat.agendar(lote, user_name, user_id, callback_url)
+            logger.info(f"⚡ Webhook confirmado; resposta para {user_name} será entregue via callback")
+            return jsonify({"messages": [], "status": "processando"})
+
+        # lotes que chegarem durante o run saem como mensagens extras desta mesma resposta
+        respostas = agrupador_mensagens.processar(
+            lote, lambda message: montar_resposta_manychat(message, user_name, user_id))
+
+        response = {"messages": [{"text": resposta} for resposta in respostas]}
         logger.info(f"✅ Resposta enviada para {user_name}")
         logger.info(f"📤 JSON resposta: {response}")
         return jsonify(response)
@@ -258,19 +1047,23 @@ def webhook_manychat():
 @app.route('/api/manychat/stats', methods=['GET'])
 def stats_manychat():
     try:
-        agora = time.time()
-        conversas_ativas = 0
-        for conversa in user_conversations.values():
-            if agora - conversa['last_activity'] < TIMEOUT_CONVERSA:
-                conversas_ativas += 1
+        conversas = armazem_conversas.estatisticas()
         stats = {
             "status": "ok",
             "timestamp": datetime.now().isoformat(),
             "estatisticas": {
-                "total_conversas": len(user_conversations),
-                "conversas_ativas": conversas_ativas,
+                "total_conversas": conversas["conversas"],
+                "conversas_ativas": conversas["conversas"],
+                "conversas_removidas_ttl": conversas["removidas_ttl"],
+                "conversas_removidas_lru": conversas["removidas_lru"],
                 "timeout_conversa": TIMEOUT_CONVERSA,
-                "max_conversas": MAX_CONVERSAS
+                "max_conversas": MAX_CONVERSAS,
+                "modo_assincrono": MANYCHAT_ASSINCRONO,
+                "entregas_assincronas": entregador_manychat.estatisticas(),
+                "agrupamento": agrupador_mensagens.estatisticas(),
+                "respostas_rapidas": respostas_rapidas.estatisticas(),
+                "runs_assistente": aguardador_runs.estatisticas(),
+                "cliente_openai": gerenciador_openai.estatisticas()
             }
         }
         return jsonify(stats)
@@ -278,12 +1071,945 @@ def stats_manychat():
         logger.error(f"❌ Erro ao obter stats: {e}")
         return jsonify({"error": "Erro interno"}), 500
 
+# ================================
+# LIMITE DE REQUISIÇÕES POR HOST
+# ================================
+class LimitadorPorHost:
+    # Balde de fichas por host: permite `rajada` requisições seguidas e depois `taxa`/s.
+    # A vaga é reservada sob lock (fichas podem ficar negativas) e a espera acontece fora dele.
+    def __init__(self, taxa, rajada):
+        self.taxa = taxa
+        self.rajada = max(1, rajada)
+        self._baldes = {}
+        self._lock = threading.Lock()
+
+    def aguardar(self, url):
+        if self.taxa <= 0:
+            return
+        host = urlparse(url).hostname or ''
+        with self._lock:
+            agora = time.monotonic()
+            fichas, ultimo = self._baldes.get(host, (float(self.rajada), agora))
+            fichas = min(float(self.rajada), fichas + (agora - ultimo) * self.taxa) - 1
+            self._baldes[host] = (fichas, agora)
+        if fichas < 0:
+            time.sleep(-fichas / self.taxa)
+
+limitador_hosts = LimitadorPorHost(TAXA_POR_HOST, RAJADA_POR_HOST)
+
+class SessaoLimitada(requests.Session):
+    # requests.Session que passa pelo limitador de host antes de cada requisição
+    def __init__(self, limitador=limitador_hosts):
+        super().__init__()
+        self.limitador = limitador
+
+    def request(self, method, url, *args, **kwargs):
+        self.limitador.aguardar(url)
+        return super().request(method, url, *args, **kwargs)
+
+    def get_condicional(self, url, cache, **kwargs):
+        # GET com If-None-Match/If-Modified-Since a partir do cache. Num 304 devolve o corpo
+        # guardado como resposta 200; retorna (response, revalidada).
+        entrada = cache.obter(url)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entrada:
+            if entrada['etag']:
+                headers['If-None-Match'] = entrada['etag']
+            if entrada['last_modified']:
+                headers['If-Modified-Since'] = entrada['last_modified']
+        response = self.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entrada:
+            guardada = requests.Response()
+            guardada.status_code = 200
+            guardada._content = entrada['corpo']
+            guardada.encoding = entrada['encoding']
+            guardada.headers = response.headers
+            guardada.url = url
+            guardada.request = response.request
+            return guardada, True
+        if response.status_code == 200:
+            cache.guardar(url, response)
+        return response, False
+
+def _percentil(valores, p):
+    # Percentil por posto mais próximo; `valores` já ordenados
+    if not valores:
+        return None
+    k = max(0, min(len(valores) - 1, math.ceil(p / 100.0 * len(valores)) - 1))
+    return valores[k]
+
+# ================================
+# CACHE PERSISTENTE (SQLITE)
+# ================================
+_engines_sqlite = {}
+_engines_sqlite_lock = threading.Lock()
+
+def obter_engine_sqlite(caminho):
+    # Uma engine por arquivo, compartilhada pelos caches do processo
+    with _engines_sqlite_lock:
+        if caminho not in _engines_sqlite:
+            _engines_sqlite[caminho] = criar_engine_sqlite(caminho)
+        return _engines_sqlite[caminho]
+
+def criar_engine_sqlite(caminho):
+    # Engine SQLite compartilhável entre threads (e processos), em modo WAL
+    engine = create_engine(f"sqlite:///{caminho}", connect_args={'check_same_thread': False, 'timeout': 30})
+
+    @event.listens_for(engine, 'connect')
+    def _pragmas(conexao, _registro):
+        cursor = conexao.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    return engine
+
+class CacheImagensProcessadas:
+    # URLs das quatro variantes já enviadas ao Catbox, por código do produto e sha256 da
+    # imagem de origem. Entradas expiram após `ttl_horas` e, acima de `max_entradas`, saem
+    # as menos acessadas. Qualquer falha de banco é tratada como miss.
+    COLUNAS_URL = ('url_600', 'url_1080', 'url_1080_mask', 'url_1080_q')
+
+    def __init__(self, caminho, ttl_horas, max_entradas):
+        self.caminho = caminho
+        self.ttl = ttl_horas * 3600
+        self.max_entradas = max_entradas
+        self._engine = None
+        self._lock = threading.Lock()
+        self.acertos_codigo = 0
+        self.acertos_hash = 0
+        self.falhas = 0
+        metadata = MetaData()
+        self.tabela = Table(
+            'cache_imagens', metadata,
+            Column('codigo', String, primary_key=True),
+            Column('hash_origem', String, primary_key=True),
+            *[Column(nome, String) for nome in self.COLUNAS_URL],
+            Column('criado_em', Float, nullable=False),
+            Column('acessado_em', Float, nullable=False),
+            Index('ix_cache_imagens_hash', 'hash_origem'),
+            Index('ix_cache_imagens_acesso', 'acessado_em'),
+        )
+        self._metadata = metadata
+
+    def _conexao(self):
+        with self._lock:
+            if self._engine is None:
+                engine = obter_engine_sqlite(self.caminho)
+                self._metadata.create_all(engine)
+                self._engine = engine
+        return self._engine.begin()
+
+    def _buscar(self, condicao):
+        agora = time.time()
+        t = self.tabela
+        with self._conexao() as conn:
+            linha = conn.execute(
+                select(t).where(condicao, t.c.criado_em >= agora - self.ttl)
+                .order_by(t.c.criado_em.desc()).limit(1)
+            ).mappings().first()
+            if not linha:
+                return None
+            conn.execute(update(t).where(t.c.codigo == linha['codigo'], t.c.hash_origem == linha['hash_origem'])
+                         .values(acessado_em=agora))
+        return tuple(linha[nome] for nome in self.COLUNAS_URL)
+
+    def buscar_por_codigo(self, codigo):
+        try:
+            urls = self._buscar(self.tabela.c.codigo == codigo)
+        except Exception as e:
+            logger.warning(f"⚠️ Cache de imagens indisponível: {e}")
+            return None
+        if urls:
+            with self._lock:
+                self.acertos_codigo += 1
+        return urls
+
+    def buscar_por_hash(self, hash_origem):
+        try:
+            urls = self._buscar(self.tabela.c.hash_origem == hash_origem)
+        except Exception as e:
+            logger.warning(f"⚠️ Cache de imagens indisponível: {e}")
+            urls = None
+        with self._lock:
+            if urls:
+                self.acertos_hash += 1
+            else:
+                self.falhas += 1
+        return urls
+
+    def salvar(self, codigo, hash_origem, urls):
+        agora = time.time()
+        t = self.tabela
+        valores = dict(zip(self.COLUNAS_URL, urls))
+        try:
+            with self._conexao() as conn:
+                stmt = sqlite_insert(t).values(codigo=codigo, hash_origem=hash_origem, criado_em=agora,
+                                               acessado_em=agora, **valores)
+                conn.execute(stmt.on_conflict_do_update(
+                    index_elements=['codigo', 'hash_origem'],
+                    set_=dict(criado_em=agora, acessado_em=agora, **valores)))
+                conn.execute(delete(t).where(t.c.criado_em < agora - self.ttl))
+                total = conn.execute(select(func.count()).select_from(t)).scalar_one()
+                if total > self.max_entradas:
+                    # remove as menos acessadas até voltar ao limite
+                    corte = conn.execute(select(t.c.acessado_em).order_by(t.c.acessado_em.desc())
+                                         .offset(self.max_entradas).limit(1)).scalar()
+                    if corte is not None:
+                        conn.execute(delete(t).where(t.c.acessado_em <= corte))
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível gravar no cache de imagens: {e}")
+
+    def estatisticas(self):
+        try:
+            with self._conexao() as conn:
+                entradas = conn.execute(select(func.count()).select_from(self.tabela)).scalar_one()
+        except Exception:
+            entradas = None
+        with self._lock:
+            acertos = self.acertos_codigo + self.acertos_hash
+            consultas = acertos + self.falhas
+            return {
+                "entradas": entradas,
+                "acertos_codigo": self.acertos_codigo,
+                "acertos_hash": self.acertos_hash,
+                "falhas": self.falhas,
+                "taxa_acerto": round(acertos / consultas, 3) if consultas else None,
+                "ttl_horas": self.ttl / 3600,
+                "max_entradas": self.max_entradas,
+            }
+
+cache_imagens = CacheImagensProcessadas(CACHE_DB_PATH, CACHE_IMAGENS_TTL_HORAS, CACHE_IMAGENS_MAX)
+
+class CachePaginasHttp:
+    # Corpo das páginas de produto com ETag/Last-Modified, para requisições condicionais,
+    # e a lista de candidatas já extraída de cada página (válida até a página mudar).
+    def __init__(self, caminho, max_entradas):
+        self.caminho = caminho
+        self.max_entradas = max_entradas
+        self._engine = None
+        self._lock = threading.Lock()
+        metadata = MetaData()
+        self.tabela = Table(
+            'cache_paginas', metadata,
+            Column('url', String, primary_key=True),
+            Column('etag', String),
+            Column('last_modified', String),
+            Column('encoding', String),
+            Column('corpo', LargeBinary, nullable=False),
+            Column('codigo', String),
+            Column('candidatas', Text),
+            Column('atualizado_em', Float, nullable=False),
+            Index('ix_cache_paginas_atualizado', 'atualizado_em'),
+        )
+        self._metadata = metadata
+
+    def _conexao(self):
+        with self._lock:
+            if self._engine is None:
+                engine = obter_engine_sqlite(self.caminho)
+                self._metadata.create_all(engine)
+                self._engine = engine
+        return self._engine.begin()
+
+    def obter(self, url):
+        try:
+            with self._conexao() as conn:
+                linha = conn.execute(select(self.tabela).where(self.tabela.c.url == url)).mappings().first()
+        except Exception as e:
+            logger.warning(f"⚠️ Cache HTTP indisponível: {e}")
+            return None
+        if not linha:
+            return None
+        entrada = dict(linha)
+        entrada['corpo'] = zlib.decompress(entrada['corpo'])
+        return entrada
+
+    def guardar(self, url, response):
+        # Página nova ou alterada: substitui o corpo e invalida as candidatas guardadas
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        t = self.tabela
+        valores = dict(etag=etag, last_modified=last_modified, encoding=response.encoding,
+                       corpo=zlib.compress(response.content), codigo=None, candidatas=None,
+                       atualizado_em=time.time())
+        try:
+            with self._conexao() as conn:
+                conn.execute(sqlite_insert(t).values(url=url, **valores)
+                             .on_conflict_do_update(index_elements=['url'], set_=valores))
+                total = conn.execute(select(func.count()).select_from(t)).scalar_one()
+                if total > self.max_entradas:
+                    corte = conn.execute(select(t.c.atualizado_em).order_by(t.c.atualizado_em.desc())
+                                         .offset(self.max_entradas).limit(1)).scalar()
+                    if corte is not None:
+                        conn.execute(delete(t).where(t.c.atualizado_em <= corte))
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível gravar no cache HTTP: {e}")
+
+    def candidatas(self, url, codigo):
+        entrada = self.obter(url)
+        if not entrada or entrada['codigo'] != codigo or entrada['candidatas'] is None:
+            return None
+        return json.loads(entrada['candidatas'])
+
+    def guardar_candidatas(self, url, codigo, candidatas):
+        t = self.tabela
+        dados = [{'url': c['url'], 'score': 0, 'motivo': c['motivo'], 'prio': c['prio']} for c in candidatas]
+        try:
+            with self._conexao() as conn:
+                conn.execute(update(t).where(t.c.url == url)
+                             .values(codigo=codigo, candidatas=json.dumps(dados, ensure_ascii=False)))
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível gravar candidatas no cache HTTP: {e}")
+
+cache_paginas = CachePaginasHttp(CACHE_DB_PATH, CACHE_PAGINAS_MAX)
+
+class ArmazemConversasSQLite:
+    # Mesmo contrato do ArmazemConversas, mas com o registro user_id -> thread numa tabela SQLite
+    # (WAL) compartilhada pelos workers do Gunicorn e que sobrevive a reinícios. Leituras passam
+    # por um cache local de `cache_segundos`; a trava por usuário junta um Lock do processo e um
+    # flock num de `faixas` arquivos fixos (hash do user_id), então só um worker roda o assistente
+    # numa thread de cada vez e o diretório de travas não cresce com o número de usuários.
+    # Falhas de banco caem no cache local, como no cache de imagens.
+    def __init__(self, caminho, max_conversas, timeout, dir_travas, cache_segundos, faixas=256):
+        self.caminho = caminho
+        self.max_conversas = max(1, max_conversas)
+        self.timeout = timeout
+        self.dir_travas = dir_travas
+        self.faixas = max(1, faixas)
+        self.cache_segundos = cache_segundos
+        self._engine = None
+        self._lock = threading.Lock()
+        self._locais = {}
+        self._travas = TravasPorUsuario()
+        self._removidas_ttl = 0
+        self._removidas_lru = 0
+        metadata = MetaData()
+        self.tabela = Table(
+            'conversas', metadata,
+            Column('user_id', String, primary_key=True),
+            Column('thread_id', String, nullable=False),
+            Column('last_activity', Float, nullable=False),
+            Index('ix_conversas_atividade', 'last_activity'),
+        )
+        self._metadata = metadata
+
+    def _conexao(self):
+        with self._lock:
+            if self._engine is None:
+                engine = obter_engine_sqlite(self.caminho)
+                self._metadata.create_all(engine)
+                self._engine = engine
+        return self._engine.begin()
+
+    @contextmanager
+    def _trava_arquivo(self, user_id, prazo):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.dir_travas, exist_ok=True)
+        # Usuários que caem na mesma faixa só se enfileiram entre workers; no processo a trava
+        # continua por usuário. Apagar o arquivo ao soltar abriria corrida com quem já o abriu.
+        faixa = int(hashlib.sha1(str(user_id).encode('utf-8')).hexdigest(), 16) % self.faixas
+        nome = f"faixa_{faixa:04d}.lock"
+        with open(os.path.join(self.dir_travas, nome), 'a') as arquivo:
+            limite = time.monotonic() + prazo
+            while True:
+                try:
+                    fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= limite:
+                        raise TimeoutError(f"Conversa de {user_id} ocupada em outro worker há mais de {prazo}s")
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+    @contextmanager
+    def bloqueio_usuario(self, user_id, prazo=CONVERSAS_TRAVA_SEGUNDOS):
+        inicio = time.monotonic()
+        with self._travas.bloquear(user_id, prazo):
+            with self._trava_arquivo(user_id, max(0, prazo - (time.monotonic() - inicio))):
+                yield
+
+    def _guardar_local(self, user_id, thread_id, agora):
+        with self._lock:
+            self._locais[user_id] = (thread_id, agora)
+            if len(self._locais) > self.max_conversas:
+                self._locais.pop(next(iter(self._locais)))
+
+    def obter_thread(self, user_id):
+        agora = time.time()
+        with self._lock:
+            local = self._locais.get(user_id)
+        if local and agora - local[1] <= self.cache_segundos:
+            return local[0]
+        t = self.tabela
+        try:
+            with self._conexao() as conn:
+                thread_id = conn.execute(select(t.c.thread_id).where(
+                    t.c.user_id == user_id, t.c.last_activity >= agora - self.timeout)).scalar()
+                if thread_id is not None:
+                    conn.execute(update(t).where(t.c.user_id == user_id).values(last_activity=agora))
+        except Exception as e:
+            logger.warning(f"⚠️ Registro de conversas indisponível: {e}")
+            if local and agora - local[1] <= self.timeout:
+                return local[0]
+            return None
+        if thread_id is None:
+            with self._lock:
+                self._locais.pop(user_id, None)
+            return None
+        self._guardar_local(user_id, thread_id, agora)
+        return thread_id
+
+    def registrar(self, user_id, thread_id):
+        agora = time.time()
+        t = self.tabela
+        try:
+            with self._conexao() as conn:
+                # Expiradas e excesso saem aqui, pelo índice de atividade, e não a cada mensagem
+                removidas = conn.execute(delete(t).where(t.c.last_activity < agora - self.timeout)).rowcount
+                existente = conn.execute(select(t.c.thread_id).where(t.c.user_id == user_id)).scalar()
+                if existente is not None:
+                    thread_id = existente
+                    conn.execute(update(t).where(t.c.user_id == user_id).values(last_activity=agora))
+                else:
+                    conn.execute(sqlite_insert(t).values(user_id=user_id, thread_id=thread_id, last_activity=agora))
+                excesso = 0
+                total = conn.execute(select(func.count()).select_from(t)).scalar_one()
+                if total > self.max_conversas:
+                    corte = conn.execute(select(t.c.last_activity).order_by(t.c.last_activity.desc())
+                                         .offset(self.max_conversas).limit(1)).scalar()
+                    if corte is not None:
+                        excesso = conn.execute(delete(t).where(t.c.last_activity <= corte)).rowcount
+            with self._lock:
+                self._removidas_ttl += max(0, removidas or 0)
+                self._removidas_lru += max(0, excesso or 0)
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível gravar no registro de conversas: {e}")
+        self._guardar_local(user_id, thread_id, agora)
+        return thread_id
+
+    def remover(self, user_id):
+        with self._lock:
+            self._locais.pop(user_id, None)
+        try:
+            with self._conexao() as conn:
+                return conn.execute(delete(self.tabela).where(self.tabela.c.user_id == user_id)).rowcount > 0
+        except Exception as e:
+            logger.warning(f"⚠️ Registro de conversas indisponível: {e}")
+            return False
+
+    def limpar_expiradas(self):
+        try:
+            with self._conexao() as conn:
+                removidas = conn.execute(delete(self.tabela).where(
+                    self.tabela.c.last_activity < time.time() - self.timeout)).rowcount
+            with self._lock:
+                self._removidas_ttl += max(0, removidas or 0)
+        except Exception as e:
+            logger.warning(f"⚠️ Registro de conversas indisponível: {e}")
+
+    def _contar(self):
+        t = self.tabela
+        try:
+            with self._conexao() as conn:
+                return conn.execute(select(func.count()).select_from(t)
+                                    .where(t.c.last_activity >= time.time() - self.timeout)).scalar_one()
+        except Exception:
+            return None
+
+    def __len__(self):
+        return self._contar() or 0
+
+    def estatisticas(self):
+        conversas = self._contar()
+        with self._lock:
+            return {"backend": "sqlite", "conversas": conversas, "removidas_ttl": self._removidas_ttl,
+                    "removidas_lru": self._removidas_lru, "cache_local": len(self._locais)}
+
+if CONVERSAS_BACKEND == 'sqlite':
+    armazem_conversas = ArmazemConversasSQLite(CONVERSAS_DB_PATH, MAX_CONVERSAS, TIMEOUT_CONVERSA,
+                                               CONVERSAS_TRAVAS_DIR, CONVERSAS_CACHE_SEGUNDOS,
+                                               CONVERSAS_TRAVAS_FAIXAS)
+else:
+    armazem_conversas = ArmazemConversas(MAX_CONVERSAS, TIMEOUT_CONVERSA)
+
+# ================================
+# PRODUTO PREPARADO (RECORTE COMPARTILHADO)
+# ================================
+# Caixa útil dos layouts verticais 1080x1920
+CANVAS_VERTICAL = (1080, 1920)
+CAIXA_VERTICAL_W = 800
+CAIXA_VERTICAL_H = min(2 * 1500, CANVAS_VERTICAL[1] - 2 * int(0.05 * min(CANVAS_VERTICAL)))
+
+class ProdutoPreparado:
+    # Imagem do produto achatada em RGB e recortada nas bordas brancas uma única vez.
+    # Os layouts 1080x1920 renderizam a partir do recorte (com redimensionamentos em cache
+    # por tamanho final) e o 600x600 a partir de `original`.
+    def __init__(self, img_produto, diff_t=16):
+        self.original = img_produto
+        if img_produto.mode == 'RGBA':
+            base_rgb = Image.new('RGB', img_produto.size, (255, 255, 255))
+            base_rgb.paste(img_produto, mask=img_produto.split()[-1])
+            rgb = base_rgb
+        else:
+            rgb = img_produto.convert('RGB') if img_produto.mode != 'RGB' else img_produto
+
+        w0, h0 = rgb.size
+        if w0 <= 0 or h0 <= 0:
+            raise ValueError("Dimensões inválidas da imagem do produto")
+
+        white_bg = Image.new('RGB', (w0, h0), (255, 255, 255))
+        diff = ImageChops.difference(rgb, white_bg)
+        gray = diff.convert('L')
+        mask = gray.point([255 if p > diff_t else 0 for p in range(256)])
+        mask = mask.filter(ImageFilter.MaxFilter(3))
+        bbox = mask.getbbox()
+
+        crop_img = rgb
+        used_crop = False
+        if bbox:
+            left, top, right, bottom = bbox
+            pad = int(0.02 * min(w0, h0))
+            left = max(0, left - pad)
+            top = max(0, top - pad)
+            right = min(w0, right + pad)
+            bottom = min(h0, bottom + pad)
+            if right - left > 10 and bottom - top > 10:
+                crop_img = rgb.crop((left, top, right, bottom))
+                used_crop = True
+
+        self.rgb = rgb
+        self.w0, self.h0 = w0, h0
+        self.crop = crop_img
+        self.used_crop = used_crop
+        self._redimensionadas = {}
+        self._miniaturas = {}
+
+    def miniatura(self, lado):
+        # Equivalente a original.copy().thumbnail((lado, lado), LANCZOS) sem copiar a base:
+        # o original é compartilhado (somente leitura) entre as variantes
+        if lado not in self._miniaturas:
+            w, h = self.original.size
+            if lado >= w and lado >= h:
+                self._miniaturas[lado] = self.original
+            else:
+                aspecto = w / h
+                def arredondar(valor, erro):
+                    return max(min(math.floor(valor), math.ceil(valor), key=erro), 1)
+                if aspecto >= 1:
+                    tamanho = (lado, arredondar(lado / aspecto, lambda n: 0 if n == 0 else abs(aspecto - lado / n)))
+                else:
+                    tamanho = (arredondar(lado * aspecto, lambda n: abs(aspecto - n / lado)), lado)
+                self._miniaturas[lado] = self.original.resize(tamanho, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        return self._miniaturas[lado]
+
+    def escala_caixa(self, box_w=CAIXA_VERTICAL_W, box_h=CAIXA_VERTICAL_H):
+        cw, ch = self.crop.size
+        return min(box_w / float(cw), box_h / float(ch))
+
+    def redimensionar(self, escala):
+        cw, ch = self.crop.size
+        tamanho = (max(1, int(round(cw * escala))), max(1, int(round(ch * escala))))
+        if tamanho not in self._redimensionadas:
+            self._redimensionadas[tamanho] = self.crop.resize(tamanho, Image.Resampling.LANCZOS)
+        return self._redimensionadas[tamanho]
+
+def fator_reducao(tamanho):
+    # Maior fator inteiro que ainda deixa a imagem com FOLGA vezes o tamanho que cabe na caixa
+    # vertical (a folga cobre o recorte das bordas brancas, que é feito depois)
+    if not DECODIFICACAO_REDUZIDA:
+        return 1
+    w, h = tamanho
+    return max(1, int(max(w / CAIXA_VERTICAL_W, h / CAIXA_VERTICAL_H) / max(1.0, DECODIFICACAO_FOLGA)))
+
+def decodificar_reduzida(conteudo):
+    # Retorna (imagem, tamanho_original). JPEG usa draft (escala 1/2, 1/4, 1/8 no próprio
+    # decodificador, sem passar pela resolução cheia); o que sobrar do fator vai por reduce.
+    img = Image.open(io.BytesIO(conteudo))
+    tamanho_original = img.size
+    fator = fator_reducao(tamanho_original)
+    if fator > 1 and img.format == 'JPEG':
+        img.draft(img.mode, (tamanho_original[0] // fator, tamanho_original[1] // fator))
+    img.load()
+    fator = fator_reducao(img.size)
+    if fator > 1:
+        if img.mode not in ('L', 'RGB', 'RGBA', 'CMYK'):
+            img = img.convert('RGB')  # reduce não trata paleta; ProdutoPreparado faria o mesmo
+        img = img.reduce(fator)
+    return img, tamanho_original
+
+# ================================
+# FONTES E SPRITES DE TEXTO
+# ================================
+FONTES_CANDIDATAS = {
+    'negrito': ("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", "arialbd.ttf"),
+    'regular': ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "arial.ttf"),
+}
+
+@functools.lru_cache(maxsize=64)
+def carregar_fonte(estilo, tamanho):
+    # TTF aberto uma vez por (estilo, tamanho) no processo; cai na fonte padrão se nenhum existir
+    for caminho in FONTES_CANDIDATAS[estilo]:
+        try:
+            return ImageFont.truetype(caminho, tamanho)
+        except Exception:
+            continue
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=32)
+def sprite_texto_contornado(texto, estilo, tamanho, cor, cor_contorno, raio):
+    # Texto com contorno quadrado de `raio` px pronto para colar: equivale a desenhar o texto
+    # com a cor do contorno em todos os deslocamentos (-raio..raio)² e o texto por cima, mas o
+    # contorno sai de uma dilatação (MaxFilter) da máscara. Devolve o sprite RGBA; cole-o em
+    # (x - raio, y - raio) usando ele mesmo como máscara para obter o draw.text((x, y)).
+    fonte = carregar_fonte(estilo, tamanho)
+    bbox = fonte.getbbox(texto)
+    tamanho_sprite = (max(1, bbox[2]) + 2 * raio, max(1, bbox[3]) + 2 * raio)
+    mascara = Image.new('L', tamanho_sprite, 0)
+    ImageDraw.Draw(mascara).text((raio, raio), texto, font=fonte, fill=255)
+    contorno = mascara.filter(ImageFilter.MaxFilter(2 * raio + 1)) if raio > 0 else mascara
+    sprite = Image.new('RGBA', tamanho_sprite, tuple(cor_contorno) + (0,))
+    sprite.putalpha(contorno)
+    sprite.paste(tuple(cor) + (255,), (0, 0), mascara)
+    return sprite
+
+# ================================
+# CAMADAS DE SOBREPOSIÇÃO (CACHE)
+# ================================
+# As camadas das variantes mascarada e '?' só dependem do tamanho do cartão/círculo: cada uma é
+# desenhada uma vez numa imagem do tamanho do seu retângulo (+ margem para sombra) e composta
+# só sobre essa região da tela, em vez de um overlay 1080x1920 inteiro por produto.
+MARGEM_CAMADA = 8
+
+def quantizar_largura(largura, passo=OVERLAY_QUANTIZACAO_PX):
+    if passo > 1 and largura >= passo:
+        return largura - largura % passo
+    return largura
+
+@functools.lru_cache(maxsize=64)
+def metricas_cartao_mascarado(card_w):
+    # (pad, spacing, alturas das três linhas, card_h) do cartão "ADIVINHE / e ganhe esse / PRODUTO"
+    s = card_w / 720.0
+    f1, f2, f3 = carregar_fonte('negrito', int(90 * s)), carregar_fonte('regular', int(48 * s)), carregar_fonte('negrito', int(90 * s))
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    alturas = []
+    for texto, fonte in (("ADIVINHE", f1), ("e ganhe esse", f2), ("PRODUTO", f3)):
+        b = draw.textbbox((0, 0), texto, font=fonte)
+        alturas.append(b[3] - b[1])
+    pad = int(24 * s)
+    spacing = int(12 * s)
+    card_h = pad + alturas[0] + spacing + alturas[1] + spacing + alturas[2] + pad
+    return pad, spacing, card_h
+
+@functools.lru_cache(maxsize=32)
+def camada_cartao_mascarado(card_w, largura, altura):
+    # Cartão vermelho com sombra e texto; o canto (MARGEM_CAMADA, MARGEM_CAMADA) é o (x0, y0) do cartão
+    s = card_w / 720.0
+    pad, spacing, _ = metricas_cartao_mascarado(card_w)
+    f1, f2, f3 = carregar_fonte('negrito', int(90 * s)), carregar_fonte('regular', int(48 * s)), carregar_fonte('negrito', int(90 * s))
+    m = MARGEM_CAMADA
+    camada = Image.new('RGBA', (largura + 2 * m, altura + 2 * m), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(camada)
+    x0, y0, x1, y1 = m, m, m + largura, m + altura
+
+    radius = int(28 * s)
+    vermelho = (200, 0, 0, 230)  # ~90% opacidade
+    sombra = (0, 0, 0, 90)
+    draw.rounded_rectangle((x0+3, y0+4, x1+3, y1+4), radius=radius, fill=sombra)
+    draw.rounded_rectangle((x0, y0, x1, y1), radius=radius, fill=vermelho)
+
+    tx = x0 + (x1 - x0) // 2
+    cursor_y = y0 + pad
+    branco90 = (255, 255, 255, 230)
+
+    def draw_center(t, f, y):
+        bbox = draw.textbbox((0, 0), t, font=f)
+        tw = bbox[2] - bbox[0]
+        x = tx - tw // 2
+        for dx, dy in ((1,0),(0,1),(-1,0),(0,-1)):
+            draw.text((x+dx, y+dy), t, font=f, fill=(0,0,0,60))
+        draw.text((x, y), t, font=f, fill=branco90)
+        return y + (bbox[3]-bbox[1])
+
+    cursor_y = draw_center("ADIVINHE", f1, cursor_y)
+    cursor_y += spacing
+    cursor_y = draw_center("e ganhe esse", f2, cursor_y)
+    cursor_y += spacing
+    _ = draw_center("PRODUTO", f3, cursor_y)
+    return camada
+
+@functools.lru_cache(maxsize=8)
+def camada_circulo_interrogacao(diam):
+    # Círculo vermelho com sombra e "?" branco; o canto (MARGEM_CAMADA, MARGEM_CAMADA) é o (x0, y0) do círculo
+    m = MARGEM_CAMADA
+    raio = diam // 2
+    camada = Image.new('RGBA', (2 * raio + 2 * m, 2 * raio + 2 * m), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(camada)
+    cx = cy = m + raio
+    x0, y0, x1, y1 = cx - raio, cy - raio, cx + raio, cy + raio
+
+    # sombra leve
+    draw.ellipse((x0+4, y0+6, x1+4, y1+6), fill=(0, 0, 0, 80))
+    draw.ellipse((x0, y0, x1, y1), fill=(200, 0, 0, 230))
+
+    # "?" central
+    f_q = carregar_fonte('negrito', int(diam * 0.8))
+    q_bbox = draw.textbbox((0, 0), "?", font=f_q)
+    q_w = q_bbox[2] - q_bbox[0]
+    q_h = q_bbox[3] - q_bbox[1]
+    q_x = cx - q_w // 2
+    q_y = cy - q_h // 2
+    # borda sutil
+    for dx, dy in ((1,0),(0,1),(-1,0),(0,-1)):
+        draw.text((q_x+dx, q_y+dy), "?", font=f_q, fill=(0,0,0,70))
+    draw.text((q_x, q_y), "?", font=f_q, fill=(255,255,255,240))
+    return camada
+
+def compor_camada(canvas, camada, x, y):
+    # alpha_composite da camada (canto em x, y) só na região que ela cobre; `canvas` RGB é alterado
+    esq, topo = max(0, x), max(0, y)
+    dir_, base = min(canvas.width, x + camada.width), min(canvas.height, y + camada.height)
+    if dir_ <= esq or base <= topo:
+        return canvas
+    regiao = canvas.crop((esq, topo, dir_, base)).convert('RGBA')
+    regiao.alpha_composite(camada, source=(esq - x, topo - y, dir_ - x, base - y))
+    canvas.paste(regiao.convert('RGB'), (esq, topo))
+    return canvas
+
+# ================================
+# CODIFICAÇÃO DAS VARIANTES
+# ================================
+class CodificadorImagem:
+    # Salva a tela no formato configurado e acumula bytes/tempo por variante. O padrão
+    # (PNG nível 6) gera exatamente os mesmos bytes do save(format='PNG', quality=95) anterior,
+    # já que o PNG ignora `quality`.
+    FORMATOS = {'png': ('PNG', '.png', 'image/png'),
+                'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+                'webp': ('WEBP', '.webp', 'image/webp')}
+    # Opções aceitas por formato: (mínimo, máximo) para as numéricas, None para as de liga/desliga
+    OPCOES = {'png': {'nivel': (0, 9), 'otimizar': None},
+              'jpeg': {'q': (1, 100), 'progressivo': None, 'subamostragem': (0, 2)},
+              'webp': {'q': (0, 100), 'metodo': (0, 6), 'sem_perda': None}}
+
+    def __init__(self, especificacao):
+        self.especificacao = especificacao
+        formato, _, opcoes = especificacao.partition(':')
+        formato = formato.strip().lower().replace('jpg', 'jpeg')
+        if formato not in self.FORMATOS:
+            raise ValueError(f"Formato de imagem não suportado: {formato}")
+        self.formato = formato
+        self.opcoes = {}
+        aceitas = self.OPCOES[formato]
+        for opcao in filter(None, (o.strip() for o in opcoes.split(','))):
+            chave, igual, valor = (parte.strip() for parte in opcao.partition('='))
+            if chave not in aceitas:
+                raise ValueError(f"Opção '{chave}' não existe para {formato} (aceitas: {', '.join(aceitas)})")
+            faixa = aceitas[chave]
+            if faixa is None:
+                if igual:
+                    raise ValueError(f"Opção '{chave}' não recebe valor")
+                self.opcoes[chave] = True
+                continue
+            if not valor.isdigit() or not faixa[0] <= int(valor) <= faixa[1]:
+                raise ValueError(f"Opção '{chave}' precisa de um inteiro entre {faixa[0]} e {faixa[1]}, recebeu '{valor}'")
+            self.opcoes[chave] = int(valor)
+        self._lock = threading.Lock()
+        self._imagens = 0
+        self._bytes = 0
+        self._segundos = 0.0
+
+    def _parametros_save(self):
+        pil, _, _ = self.FORMATOS[self.formato]
+        op = self.opcoes
+        if self.formato == 'png':
+            return dict(format=pil, compress_level=op.get('nivel', 6), optimize=bool(op.get('otimizar', False)))
+        if self.formato == 'jpeg':
+            return dict(format=pil, quality=op.get('q', 90), optimize=True,
+                        progressive=bool(op.get('progressivo', False)), subsampling=op.get('subamostragem', 0))
+        return dict(format=pil, quality=op.get('q', 90), method=op.get('metodo', 4),
+                    lossless=bool(op.get('sem_perda', False)))
+
+    def codificar(self, imagem):
+        inicio = time.perf_counter()
+        buffer = io.BytesIO()
+        imagem.save(buffer, **self._parametros_save())
+        duracao = time.perf_counter() - inicio
+        tamanho = buffer.tell()
+        buffer.seek(0)
+        with self._lock:
+            self._imagens += 1
+            self._bytes += tamanho
+            self._segundos += duracao
+        return buffer, tamanho, duracao
+
+    def arquivo(self, nome_arquivo):
+        # (nome com a extensão do formato, mime) para o upload
+        _, extensao, mime = self.FORMATOS[self.formato]
+        return os.path.splitext(nome_arquivo)[0] + extensao, mime
+
+    def estatisticas(self):
+        with self._lock:
+            n = self._imagens
+            return {"codificacao": self.especificacao, "imagens": n, "bytes_total": self._bytes,
+                    "kb_medio": round(self._bytes / n / 1024, 1) if n else None,
+                    "ms_medio": round(self._segundos / n * 1000, 1) if n else None}
+
+_codificadores = {}
+_codificadores_lock = threading.Lock()
+
+def codificador_variante(nome_arquivo):
+    # Um codificador por variante (chave = nome do arquivo sem extensão), lido do ambiente na 1ª vez
+    base = os.path.splitext(nome_arquivo)[0]
+    with _codificadores_lock:
+        if base not in _codificadores:
+            especificacao = os.getenv(f"CODIFICACAO_{base.upper()}", CODIFICACAO_PADRAO)
+            try:
+                _codificadores[base] = CodificadorImagem(especificacao)
+            except Exception as e:
+                logger.warning(f"⚠️ Codificação inválida para {base} ({especificacao}): {e} - usando PNG")
+                _codificadores[base] = CodificadorImagem('png:nivel=6')
+        return _codificadores[base]
+
+def estatisticas_codificacao():
+    with _codificadores_lock:
+        codificadores = dict(_codificadores)
+    return {base: c.estatisticas() for base, c in codificadores.items()}
+
+# ================================
+# EXPRESSÕES PRÉ-COMPILADAS
+# ================================
+RE_CODIGO_URL = re.compile(r'(NATBRA|AVNBRA)-?(\d+)', re.IGNORECASE)
+# Imagens do CDN da Natura; as da pasta Produtos/produtos têm precedência (ver _urls_cdn)
+RE_CDN_NATURA = re.compile(r'https://production\.na01\.natura\.com/[^\s"\'\)]+/(?:NATBRA|AVNBRA)-\d+_[1-4]\.(?:jpg|png)')
+RE_URL_CSS = re.compile(r'url\(([^)]+)\)')
+
+class MatcherCodigo:
+    # Testa numa única busca compilada se o texto contém o código com ou sem hífen
+    def __init__(self, codigo):
+        variantes = sorted({codigo, codigo.replace('-', '')}, key=len, reverse=True)
+        self.regex = re.compile('|'.join(re.escape(v) for v in variantes))
+
+    def __call__(self, texto):
+        return bool(texto) and self.regex.search(texto) is not None
+
+@functools.lru_cache(maxsize=256)
+def matcher_codigo(codigo):
+    return MatcherCodigo(codigo)
+
+def _urls_cdn(html_text):
+    # Uma varredura com RE_CDN_NATURA; as URLs em .../Produtos/ vêm antes das demais,
+    # como na busca antiga com duas expressões separadas
+    urls = RE_CDN_NATURA.findall(html_text)
+    pasta_produtos = [u for u in urls if u.rsplit('/', 2)[-2] in ('Produtos', 'produtos')]
+    return pasta_produtos + urls
+
+# ================================
+# EXTRATOR DE CANDIDATAS (VARREDURA ÚNICA)
+# ================================
+GALERIAS_PRODUTO = ('.product-gallery img', '.swiper-slide img', '.glide__slide img', '[data-testid="thumbnail"] img')
+
+class ExtratorCandidatasHTML(HTMLParser):
+    # Uma passada pelo HTML junta, por categoria e na ordem do documento, tudo o que
+    # extrair_candidatas_html consulta: <img>, <source>, estilos com background-image,
+    # preloads de imagem, ld+json, imagens de galeria, <picture><source> e meta og/twitter.
+    # As tags sem fechamento são as mesmas do treebuilder html.parser do BeautifulSoup.
+    VAZIAS = frozenset((
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+        'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+        'image', 'isindex', 'nextid', 'spacer',
+    ))
+    CLASSES_GALERIA = (('product-gallery', GALERIAS_PRODUTO[0]),
+                       ('swiper-slide', GALERIAS_PRODUTO[1]),
+                       ('glide__slide', GALERIAS_PRODUTO[2]))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.imgs = []
+        self.sources = []
+        self.estilos = []
+        self.preloads = []
+        self.ld_json = []
+        self.galerias = {sel: [] for sel in GALERIAS_PRODUTO}
+        self.picture_sources = []
+        self.meta_og = None
+        self.meta_twitter = None
+        self._pilha = []
+        self._abertos = dict.fromkeys(list(GALERIAS_PRODUTO) + ['picture'], 0)
+        self._script_ld = None
+
+    def _marcadores(self, tag, attrs):
+        marcas = []
+        classes = (attrs.get('class') or '').split()
+        for classe, sel in self.CLASSES_GALERIA:
+            if classe in classes:
+                marcas.append(sel)
+        if attrs.get('data-testid') == 'thumbnail':
+            marcas.append(GALERIAS_PRODUTO[3])
+        if tag == 'picture':
+            marcas.append('picture')
+        return marcas
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        style = attrs.get('style')
+        if style and 'background-image' in style:
+            self.estilos.append(style)
+        if tag == 'img':
+            self.imgs.append(attrs)
+            for sel in GALERIAS_PRODUTO:
+                if self._abertos[sel]:
+                    self.galerias[sel].append(attrs)
+        elif tag == 'source':
+            self.sources.append(attrs)
+            if self._abertos['picture']:
+                self.picture_sources.append(attrs)
+        elif tag == 'link':
+            if ' '.join((attrs.get('rel') or '').split()) == 'preload' and attrs.get('as') == 'image':
+                self.preloads.append(attrs.get('href'))
+        elif tag == 'meta':
+            if self.meta_og is None and attrs.get('property') == 'og:image':
+                self.meta_og = attrs
+            if self.meta_twitter is None and attrs.get('name') == 'twitter:image':
+                self.meta_twitter = attrs
+        elif tag == 'script' and attrs.get('type') == 'application/ld+json':
+            self._script_ld = []
+
+        if tag not in self.VAZIAS:
+            marcas = self._marcadores(tag, attrs)
+            for marca in marcas:
+                self._abertos[marca] += 1
+            self._pilha.append((tag, marcas))
+
+    def handle_data(self, data):
+        if self._script_ld is not None:
+            self._script_ld.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'script' and self._script_ld is not None:
+            self.ld_json.append(''.join(self._script_ld))
+            self._script_ld = None
+        # Como no BeautifulSoup: fecha até a última tag aberta com esse nome; sem par, ignora
+        for i in range(len(self._pilha) - 1, -1, -1):
+            if self._pilha[i][0] == tag:
+                for _, marcas in self._pilha[i:]:
+                    for marca in marcas:
+                        self._abertos[marca] -= 1
+                del self._pilha[i:]
+                break
+
 # ================================
 # PROCESSADOR DE IMAGENS V5.0
 # ================================
 class ProcessadorSorteioV5:
     def __init__(self):
-        self.session = requests.Session()
+        self.session = SessaoLimitada()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept-Language': 'pt-BR,pt;q=0.9',
@@ -291,14 +2017,16 @@ class ProcessadorSorteioV5:
         })
         # Threshold para detectar não-branco no recorte automático (0..255)
         self.DIFF_T = 16
+        # Threshold de canal para considerar um pixel de borda "branco" (0..255)
+        self.BRANCO_T = 240
+        self._lut_branco = [255 if v > self.BRANCO_T else 0 for v in range(256)] * 3
         logger.info("🎯 PROCESSADOR V5.0 INICIADO - Extração por código + validação fundo branco")
 
     def extrair_codigo_produto(self, url):
         try:
-            m = re.search(r'((?:NATBRA|AVNBRA)-?\d+)', url, re.IGNORECASE)
+            m = RE_CODIGO_URL.search(url)
             if m:
-                bruto = m.group(1).upper()
-                codigo = re.sub(r'^(NATBRA|AVNBRA)-?(\d+)$', r'\1-\2', bruto)
+                codigo = f"{m.group(1).upper()}-{m.group(2)}"
                 logger.info(f"📋 Código extraído: {codigo}")
                 return codigo
             else:
@@ -308,6 +2036,27 @@ class ProcessadorSorteioV5:
             logger.error(f"❌ Erro ao extrair código: {e}")
             return None
 
+    def _mascara_branco(self, faixa):
+        # 255 onde os três canais passam de BRANCO_T, 0 no resto (equivale ao teste r/g/b > 240)
+        r, g, b = faixa.point(self._lut_branco).split()
+        return ImageChops.darker(ImageChops.darker(r, g), b)
+
+    @staticmethod
+    def _contar_amostras_brancas(mascara, passo=5):
+        # Conta pixels 255 nas colunas 0, passo, 2*passo... de todas as linhas da máscara.
+        # A largura é completada até múltiplo de `passo` para que o fatiamento dos bytes
+        # caia sempre nas mesmas colunas em todas as linhas.
+        w, h = mascara.size
+        if w <= 0 or h <= 0:
+            return 0, 0
+        colunas = -(-w // passo)
+        if colunas * passo != w:
+            alinhada = Image.new('L', (colunas * passo, h), 0)
+            alinhada.paste(mascara, (0, 0))
+            mascara = alinhada
+        amostra = mascara.tobytes()[::passo]
+        return amostra.count(255), colunas * h
+
     def validar_fundo_branco(self, img):
         try:
             if img.mode != 'RGB':
@@ -317,29 +2066,22 @@ class ProcessadorSorteioV5:
             pixels_amostrados = 0
             border_size = min(width, height) // 10
 
-            for x in range(0, width, 5):
-                for y in range(border_size):
-                    r, g, b = img.getpixel((x, y))
-                    if r > 240 and g > 240 and b > 240:
-                        pixels_brancos += 1
-                    pixels_amostrados += 1
-            for x in range(0, width, 5):
-                for y in range(height - border_size, height):
-                    r, g, b = img.getpixel((x, y))
-                    if r > 240 and g > 240 and b > 240:
-                        pixels_brancos += 1
-                    pixels_amostrados += 1
-            for y in range(0, height, 5):
-                for x in range(border_size):
-                    r, g, b = img.getpixel((x, y))
-                    if r > 240 and g > 240 and b > 240:
-                        pixels_brancos += 1
-                    pixels_amostrados += 1
-                for x in range(width - border_size, width):
-                    r, g, b = img.getpixel((x, y))
-                    if r > 240 and g > 240 and b > 240:
-                        pixels_brancos += 1
-                    pixels_amostrados += 1
+            # Mesma amostragem do laço original (passo 5 ao longo da faixa, todos os pixels
+            # na espessura da borda), mas processada em bloco por faixa.
+            if border_size > 0:
+                faixas = (
+                    (img.crop((0, 0, width, border_size)), False),
+                    (img.crop((0, height - border_size, width, height)), False),
+                    (img.crop((0, 0, border_size, height)), True),
+                    (img.crop((width - border_size, 0, width, height)), True),
+                )
+                for faixa, vertical in faixas:
+                    mascara = self._mascara_branco(faixa)
+                    if vertical:
+                        mascara = mascara.transpose(Image.Transpose.TRANSPOSE)
+                    brancos, amostrados = self._contar_amostras_brancas(mascara)
+                    pixels_brancos += brancos
+                    pixels_amostrados += amostrados
 
             if pixels_amostrados > 0:
                 percentual = (pixels_brancos / pixels_amostrados) * 100
@@ -354,186 +2096,292 @@ class ProcessadorSorteioV5:
     def extrair_imagens_por_codigo(self, url, codigo_produto):
         try:
             logger.info(f"🔍 Buscando imagens para código: {codigo_produto}")
-            response = self.session.get(url, timeout=20)
+            response, revalidada = self.session.get_condicional(url, cache_paginas, timeout=20)
             if response.status_code != 200:
                 return [], "Erro ao acessar página do produto"
+            if revalidada:
+                candidatas = cache_paginas.candidatas(url, codigo_produto)
+                if candidatas is not None:
+                    logger.info(f"♻️ Página sem alterações (304) - {len(candidatas)} candidata(s) do cache")
+                    return candidatas, "Candidatas extraídas com sucesso (cache)"
 
-            soup = BeautifulSoup(response.content, 'html.parser')
-            html_text = response.text
-            candidatas = []
-            vistos = set()
-
-            def lixo(u: str) -> bool:
-                if not u:
-                    return True
-                ul = u.lower()
-                if 'images.rede.natura.net' in ul:
-                    return True
-                if 'logo' in ul:
-                    return True
-                if 'banner' in ul:
-                    return True
-                if '/produtosjoia/background/' in ul:
-                    return True
-                if 'bannerjoia' in ul:
-                    return True
-                return False
-
-            def add_cand(src, motivo, prio):
-                if not src:
-                    return
-                if src.startswith('//'):
-                    src = 'https:' + src
-                if src.startswith('/'):
-                    src = urljoin(url, src)
-                src_clean = (src.split('?')[0] or '').strip()
-                if not src_clean or lixo(src_clean):
-                    return
-                if src_clean not in vistos:
-                    vistos.add(src_clean)
-                    candidatas.append({'url': src_clean, 'score': 0, 'motivo': motivo, 'prio': prio})
-                    logger.info(f"✅ Candidata ({motivo}): {src_clean}")
-
-            def pick_srcset(val):
-                try:
-                    return val.split(',')[-1].strip().split(' ')[0]
-                except Exception:
-                    return None
-
-            cdn_patterns = [
-                r'https://production\.na01\.natura\.com/[^\s"\'\)]+/(?:Produtos|produtos)/(?:NATBRA|AVNBRA)-\d+_[1-4]\.(?:jpg|png)',
-                r'https://production\.na01\.natura\.com/[^\s"\'\)]+/(?:NATBRA|AVNBRA)-\d+_[1-4]\.(?:jpg|png)'
-            ]
-            for pat in cdn_patterns:
-                for m in re.findall(pat, html_text):
-                    add_cand(m, 'regex CDN', 0)
-
-            imgs = soup.find_all('img')
-            for img in imgs:
-                for attr in ('src', 'data-src', 'data-lazy-src', 'data-original', 'data-image'):
-                    v = img.get(attr)
-                    if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
-                        add_cand(v, f'Contém código {codigo_produto}', 1)
-                for attr in ('srcset', 'data-srcset'):
-                    v = img.get(attr)
-                    if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
-                        add_cand(pick_srcset(v), f'srcset contém código {codigo_produto}', 1)
-
-            for source in soup.find_all('source'):
-                v = source.get('srcset') or source.get('data-srcset')
-                if v and (codigo_produto in v or codigo_produto.replace('-', '') in v):
-                    add_cand(pick_srcset(v), f'<source> contém código {codigo_produto}', 1)
-
-            for el in soup.select('[style*="background-image"]'):
-                style = el.get('style', '')
-                for m in re.findall(r'url\(([^)]+)\)', style):
-                    m = m.strip('\'" ')
-                    if codigo_produto in m or codigo_produto.replace('-', '') in m:
-                        add_cand(m, 'background-image contém código', 1)
-
-            for lk in soup.select('link[rel="preload"][as="image"]'):
-                add_cand(lk.get('href'), 'link preload image', 2)
-
-            if not candidatas:
-                for s in soup.select('script[type="application/ld+json"]'):
-                    try:
-                        data = json.loads(s.string or '')
-                        img_field = data.get('image')
-                        if isinstance(img_field, str):
-                            add_cand(img_field, 'json-ld image', 2)
-                        elif isinstance(img_field, list) and img_field:
-                            add_cand(img_field[0], 'json-ld image[0]', 2)
-                    except Exception:
-                        continue
-
-            if not candidatas:
-                for sel in ('.product-gallery img', '.swiper-slide img', '.glide__slide img', '[data-testid="thumbnail"] img'):
-                    for g in soup.select(sel):
-                        add_cand(g.get('src') or g.get('data-src') or pick_srcset(g.get('srcset') or ''), f'galeria {sel}', 3)
-                for source in soup.select('picture source'):
-                    add_cand(pick_srcset(source.get('srcset') or ''), 'picture source', 3)
-
-            if not candidatas:
-                m = soup.find('meta', {'property': 'og:image'}) or soup.find('meta', {'name': 'twitter:image'})
-                add_cand(m.get('content') if m else None, 'meta image', 4)
-
+            candidatas = self.extrair_candidatas_html(response.text, url, codigo_produto)
             if not candidatas:
                 logger.error("❌ Nenhuma imagem candidata encontrada na página")
                 return [], "Nenhuma imagem candidata encontrada na página"
 
-            candidatas.sort(key=lambda x: x.get('prio', 99))
             logger.info(f"📋 Candidatas encontradas: {len(candidatas)}")
+            cache_paginas.guardar_candidatas(url, codigo_produto, candidatas)
             return candidatas, "Candidatas extraídas com sucesso"
         except Exception as e:
             logger.error(f"❌ Erro ao extrair imagens: {e}")
             return [], f"Erro na extração: {str(e)}"
 
+    def extrair_candidatas_html(self, html_text, url, codigo_produto):
+        candidatas = []
+        vistos = set()
+        contem_codigo = matcher_codigo(codigo_produto)
+
+        def lixo(u: str) -> bool:
+            if not u:
+                return True
+            ul = u.lower()
+            if 'images.rede.natura.net' in ul:
+                return True
+            if 'logo' in ul:
+                return True
+            if 'banner' in ul:
+                return True
+            if '/produtosjoia/background/' in ul:
+                return True
+            if 'bannerjoia' in ul:
+                return True
+            return False
+
+        def add_cand(src, motivo, prio):
+            if not src:
+                return
+            if src.startswith('//'):
+                src = 'https:' + src
+            if src.startswith('/'):
+                src = urljoin(url, src)
+            src_clean = (src.split('?')[0] or '').strip()
+            if not src_clean or lixo(src_clean):
+                return
+            if src_clean not in vistos:
+                vistos.add(src_clean)
+                candidatas.append({'url': src_clean, 'score': 0, 'motivo': motivo, 'prio': prio})
+                logger.info(f"✅ Candidata ({motivo}): {src_clean}")
+
+        def pick_srcset(val):
+            try:
+                return val.split(',')[-1].strip().split(' ')[0]
+            except Exception:
+                return None
+
+        for m in _urls_cdn(html_text):
+            add_cand(m, 'regex CDN', 0)
+
+        # Uma única varredura do documento; as categorias são consumidas na mesma ordem de prioridade
+        extrator = ExtratorCandidatasHTML()
+        extrator.feed(html_text)
+        extrator.close()
+
+        for img in extrator.imgs:
+            for attr in ('src', 'data-src', 'data-lazy-src', 'data-original', 'data-image'):
+                v = img.get(attr)
+                if contem_codigo(v):
+                    add_cand(v, f'Contém código {codigo_produto}', 1)
+            for attr in ('srcset', 'data-srcset'):
+                v = img.get(attr)
+                if contem_codigo(v):
+                    add_cand(pick_srcset(v), f'srcset contém código {codigo_produto}', 1)
+
+        for source in extrator.sources:
+            v = source.get('srcset') or source.get('data-srcset')
+            if contem_codigo(v):
+                add_cand(pick_srcset(v), f'<source> contém código {codigo_produto}', 1)
+
+        for style in extrator.estilos:
+            for m in RE_URL_CSS.findall(style):
+                m = m.strip('\'" ')
+                if contem_codigo(m):
+                    add_cand(m, 'background-image contém código', 1)
+
+        for href in extrator.preloads:
+            add_cand(href, 'link preload image', 2)
+
+        if not candidatas:
+            for texto in extrator.ld_json:
+                try:
+                    data = json.loads(texto)
+                    img_field = data.get('image')
+                    if isinstance(img_field, str):
+                        add_cand(img_field, 'json-ld image', 2)
+                    elif isinstance(img_field, list) and img_field:
+                        add_cand(img_field[0], 'json-ld image[0]', 2)
+                except Exception:
+                    continue
+
+        if not candidatas:
+            for sel in GALERIAS_PRODUTO:
+                for g in extrator.galerias[sel]:
+                    add_cand(g.get('src') or g.get('data-src') or pick_srcset(g.get('srcset') or ''), f'galeria {sel}', 3)
+            for source in extrator.picture_sources:
+                add_cand(pick_srcset(source.get('srcset') or ''), 'picture source', 3)
+
+        if not candidatas:
+            m = extrator.meta_og or extrator.meta_twitter
+            add_cand(m.get('content') if m else None, 'meta image', 4)
+
+        candidatas.sort(key=lambda x: x.get('prio', 99))
+        return candidatas
+
+    # Pontuação máxima: fundo ≥80% (+500) e ≥800px nos dois lados (+200)
+    SCORE_MAXIMO = 1000 + 500 + 200
+    # Teto de quem não alcança 400px nos dois lados (sem bônus de tamanho)
+    SCORE_SEM_BONUS = 1000 + 500
+
+    def _pontuar_imagem(self, percentual, tamanho):
+        score = 1000
+        if percentual >= 80:
+            score += 500
+        elif percentual >= 70:
+            score += 300
+        else:
+            score += 100
+        width, height = tamanho
+        if width >= 800 and height >= 800:
+            score += 200
+        elif width >= 400 and height >= 400:
+            score += 100
+        return score
+
+    def _avaliar_candidata(self, i, total, candidata):
+        try:
+            logger.info(f"📋 Avaliando {i+1}/{total}: {candidata['url']}")
+            response = self.session.get(candidata['url'], timeout=10)
+            if response.status_code != 200:
+                return None
+            img, tamanho_original = decodificar_reduzida(response.content)
+            tem_fundo_branco, percentual = self.validar_fundo_branco(img)
+            candidata['sha256'] = hashlib.sha256(response.content).hexdigest()
+            if not tem_fundo_branco:
+                logger.info(f"❌ REJEITADA - Fundo: {percentual:.1f}%")
+                return None
+            # bônus de tamanho pela resolução de origem, não pela decodificada
+            score = self._pontuar_imagem(percentual, tamanho_original)
+            candidata['score'] = score
+            candidata['percentual_branco'] = percentual
+            candidata['imagem'] = img
+            logger.info(f"✅ APROVADA - Score: {score}, Fundo: {percentual:.1f}%")
+            return candidata
+        except Exception as e:
+            logger.error(f"❌ Erro ao avaliar: {e}")
+            return None
+
+    def _sondar_candidata(self, candidata):
+        # Lê só o começo do arquivo (Range + stream) até o Pillow conhecer as dimensões.
+        # Retorna (acessivel, (w, h) ou None se o cabeçalho não pôde ser lido).
+        try:
+            headers = {'Range': f'bytes=0-{SONDAGEM_BYTES - 1}'}
+            with self.session.get(candidata['url'], headers=headers, stream=True, timeout=10) as response:
+                if response.status_code not in (200, 206):
+                    return False, None
+                parser = ImageFile.Parser()
+                lidos = 0
+                for bloco in response.iter_content(8192):
+                    parser.feed(bloco)
+                    lidos += len(bloco)
+                    if parser.image is not None or lidos >= SONDAGEM_BYTES:
+                        break
+            return True, (parser.image.size if parser.image is not None else None)
+        except Exception as e:
+            logger.warning(f"⚠️ Sondagem falhou para {candidata['url']}: {e}")
+            return True, None
+
+    def _filtrar_por_sondagem(self, executor, candidatas, prazo):
+        # Descarta, antes do download completo, candidatas inacessíveis e miniaturas. Retorna
+        # (prioritárias, sem_bonus): as que sabidamente não chegam a 400px nos dois lados só
+        # são avaliadas se as prioritárias não bastarem (ver selecionar_candidata).
+        futuros = [executor.submit(self._sondar_candidata, c) for c in candidatas]
+        wait(futuros, timeout=max(0.0, prazo - time.monotonic()))
+        prioritarias, sem_bonus = [], []
+        for i, (candidata, futuro) in enumerate(zip(candidatas, futuros)):
+            acessivel, tamanho = futuro.result() if futuro.done() else (True, None)
+            if not acessivel:
+                logger.info(f"❌ DESCARTADA na sondagem (HTTP): {candidata['url']}")
+                continue
+            if tamanho and min(tamanho) < IMG_MIN_LADO:
+                logger.info(f"❌ DESCARTADA na sondagem (miniatura {tamanho[0]}x{tamanho[1]}): {candidata['url']}")
+                continue
+            candidata['dimensoes'] = tamanho
+            if tamanho is not None and min(tamanho) < 400:
+                sem_bonus.append((i, candidata))
+            else:
+                prioritarias.append((i, candidata))
+        return prioritarias, sem_bonus
+
+    def _avaliar_grupo(self, executor, grupo, total, prazo, melhores):
+        # Avalia as candidatas do grupo em paralelo, acrescentando as aprovadas em `melhores`.
+        # Uma candidata com pontuação máxima cancela as posteriores, que no máximo empatariam.
+        futuros = {executor.submit(self._avaliar_candidata, i, total, candidata): i for i, candidata in grupo}
+        pendentes = set(futuros)
+        indice_imbativel = None
+        while pendentes:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                logger.warning(f"⏱️ Prazo de avaliação esgotado - {len(pendentes)} candidata(s) descartada(s)")
+                break
+            prontos, pendentes = wait(pendentes, timeout=restante, return_when=FIRST_COMPLETED)
+            for futuro in prontos:
+                aprovada = futuro.result()
+                if not aprovada:
+                    continue
+                i = futuros[futuro]
+                melhores.append((i, aprovada))
+                if aprovada['score'] >= self.SCORE_MAXIMO and (indice_imbativel is None or i < indice_imbativel):
+                    indice_imbativel = i
+            if indice_imbativel is not None:
+                # Candidatas posteriores no máximo empatam, e o empate fica com a primeira da lista
+                descartadas = [f for f in pendentes if futuros[f] > indice_imbativel]
+                for futuro in descartadas:
+                    futuro.cancel()
+                    pendentes.discard(futuro)
+                if descartadas:
+                    logger.info(f"⏭️ Candidata {indice_imbativel+1} imbatível - {len(descartadas)} avaliação(ões) cancelada(s)")
+
     def avaliar_e_selecionar_imagem(self, candidatas):
+        melhor, mensagem = self.selecionar_candidata(candidatas)
+        return (melhor['imagem'] if melhor else None), mensagem
+
+    def selecionar_candidata(self, candidatas):
         try:
             logger.info("🔍 Avaliando candidatas...")
             melhores = []
-            for i, candidata in enumerate(candidatas):
-                logger.info(f"📋 Avaliando {i+1}/{len(candidatas)}: {candidata['url']}")
-                try:
-                    response = self.session.get(candidata['url'], timeout=10)
-                    if response.status_code != 200:
-                        continue
-                    img = Image.open(io.BytesIO(response.content))
-                    tem_fundo_branco, percentual = self.validar_fundo_branco(img)
-                    if tem_fundo_branco:
-                        score = 1000
-                        if percentual >= 80:
-                            score += 500
-                        elif percentual >= 70:
-                            score += 300
-                        else:
-                            score += 100
-                        width, height = img.size
-                        if width >= 800 and height >= 800:
-                            score += 200
-                        elif width >= 400 and height >= 400:
-                            score += 100
-                        candidata['score'] = score
-                        candidata['percentual_branco'] = percentual
-                        candidata['imagem'] = img
-                        melhores.append(candidata)
-                        logger.info(f"✅ APROVADA - Score: {score}, Fundo: {percentual:.1f}%")
-                    else:
-                        logger.info(f"❌ REJEITADA - Fundo: {percentual:.1f}%")
-                except Exception as e:
-                    logger.error(f"❌ Erro ao avaliar: {e}")
-                    continue
+            if not candidatas:
+                return None, "Nenhuma imagem com fundo branco adequado (≥60%)"
+
+            prazo = time.monotonic() + AVALIACAO_PRAZO_SEGUNDOS
+            executor = ThreadPoolExecutor(max_workers=max(1, min(AVALIACAO_WORKERS, len(candidatas))))
+            try:
+                prioritarias, sem_bonus = self._filtrar_por_sondagem(executor, candidatas, prazo)
+                self._avaliar_grupo(executor, prioritarias, len(candidatas), prazo, melhores)
+                if melhores and sem_bonus:
+                    # Sem bônus de tamanho o teto é SCORE_SEM_BONUS; só vale baixar as que ainda
+                    # podem superar a melhor (ou empatar com ela estando antes na lista)
+                    i_melhor, melhor = min(melhores, key=lambda x: (-x[1]['score'], x[0]))
+                    sem_bonus = [(i, c) for i, c in sem_bonus
+                                 if self.SCORE_SEM_BONUS > melhor['score']
+                                 or (self.SCORE_SEM_BONUS == melhor['score'] and i < i_melhor)]
+                if sem_bonus:
+                    logger.info(f"🔎 Avaliando {len(sem_bonus)} candidata(s) menores que 400px")
+                    self._avaliar_grupo(executor, sem_bonus, len(candidatas), prazo, melhores)
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
 
             if not melhores:
                 return None, "Nenhuma imagem com fundo branco adequado (≥60%)"
 
-            melhores.sort(key=lambda x: x['score'], reverse=True)
-            melhor = melhores[0]
+            melhores.sort(key=lambda x: (-x[1]['score'], x[0]))
+            melhor = melhores[0][1]
+            for _, perdedora in melhores[1:]:
+                perdedora.pop('imagem', None)  # libera as decodificadas que não vão ser usadas
             logger.info(f"🏆 MELHOR: Score {melhor['score']}, Fundo {melhor['percentual_branco']:.1f}%")
-            return melhor['imagem'], "Imagem selecionada com sucesso"
+            return melhor, "Imagem selecionada com sucesso"
         except Exception as e:
             logger.error(f"❌ Erro na avaliação: {e}")
             return None, f"Erro na avaliação: {str(e)}"
 
-    def _load_fonts(self, s1, s2, s3):
-        try:
-            f1 = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", s1)
-            f2 = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", s2)
-            f3 = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", s3)
-            return f1, f2, f3
-        except:
-            try:
-                f1 = ImageFont.truetype("arialbd.ttf", s1)
-                f2 = ImageFont.truetype("arial.ttf", s2)
-                f3 = ImageFont.truetype("arialbd.ttf", s3)
-                return f1, f2, f3
-            except:
-                return ImageFont.load_default(), ImageFont.load_default(), ImageFont.load_default()
+    def preparar_produto(self, img_produto):
+        if isinstance(img_produto, ProdutoPreparado):
+            return img_produto
+        return ProdutoPreparado(img_produto, self.DIFF_T)
 
     def processar_imagem_sorteio(self, img_produto):
         try:
             logger.info("🎨 Processando imagem para sorteio...")
-            img_produto.thumbnail((540, 540), Image.Resampling.LANCZOS)
+            img_produto = self.preparar_produto(img_produto).miniatura(540)
             canvas = Image.new('RGB', (600, 600), (255, 255, 255))
             produto_width, produto_height = img_produto.size
             pos_x = (600 - produto_width) // 2
@@ -542,47 +2390,31 @@ class ProcessadorSorteioV5:
                 canvas.paste(img_produto, (pos_x, pos_y), img_produto)
             else:
                 canvas.paste(img_produto, (pos_x, pos_y))
-            try:
-                fonte_media = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
-                fonte_grande = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 96)
-            except:
-                try:
-                    fonte_media = ImageFont.truetype("arial.ttf", 60)
-                    fonte_grande = ImageFont.truetype("arial.ttf", 96)
-                except:
-                    fonte_media = ImageFont.load_default()
-                    fonte_grande = ImageFont.load_default()
+            fonte_media = carregar_fonte('negrito', 60)
+            fonte_grande = carregar_fonte('negrito', 96)
 
-            draw = ImageDraw.Draw(canvas)
             cor_vermelha = (139, 0, 0)
             cor_contorno = (255, 255, 255)
 
+            # Legendas fixas: sprites com contorno renderizados uma vez por processo
             texto_superior = "Ganhe esse Top!"
-            bbox_superior = draw.textbbox((0, 0), texto_superior, font=fonte_media)
+            bbox_superior = fonte_media.getbbox(texto_superior)
             largura_superior = bbox_superior[2] - bbox_superior[0]
             x_superior = (600 - largura_superior) // 2
             y_superior = 20
-            for dx in range(-4, 5):
-                for dy in range(-4, 5):
-                    if dx != 0 or dy != 0:
-                        draw.text((x_superior + dx, y_superior + dy), texto_superior, font=fonte_media, fill=cor_contorno)
-            draw.text((x_superior, y_superior), texto_superior, font=fonte_media, fill=cor_vermelha)
+            sprite = sprite_texto_contornado(texto_superior, 'negrito', 60, cor_vermelha, cor_contorno, 4)
+            canvas.paste(sprite, (x_superior - 4, y_superior - 4), sprite)
 
             texto_inferior = "Sorteio"
-            bbox_inferior = draw.textbbox((0, 0), texto_inferior, font=fonte_grande)
+            bbox_inferior = fonte_grande.getbbox(texto_inferior)
             largura_inferior = bbox_inferior[2] - bbox_inferior[0]
             altura_inferior = bbox_inferior[3] - bbox_inferior[1]
             x_inferior = (600 - largura_inferior) // 2
             y_inferior = 600 - altura_inferior - 20
-            for dx in range(-6, 7):
-                for dy in range(-6, 7):
-                    if dx != 0 or dy != 0:
-                        draw.text((x_inferior + dx, y_inferior + dy), texto_inferior, font=fonte_grande, fill=cor_contorno)
-            draw.text((x_inferior, y_inferior), texto_inferior, font=fonte_grande, fill=cor_vermelha)
-
-            buffer = io.BytesIO()
-            canvas.save(buffer, format='PNG', quality=95)
-            buffer.seek(0)
+            sprite = sprite_texto_contornado(texto_inferior, 'negrito', 96, cor_vermelha, cor_contorno, 6)
+            canvas.paste(sprite, (x_inferior - 6, y_inferior - 6), sprite)
+
+            buffer = self._codificar(canvas, 'sorteio_600')
             logger.info("✅ Imagem processada com sucesso")
             return buffer, "Imagem processada conforme PDF"
         except Exception as e:
@@ -593,72 +2425,35 @@ class ProcessadorSorteioV5:
     def processar_imagem_vertical_1080x1920(self, img_produto):
         try:
             logger.info("🎨 Processando imagem vertical 1080x1920 (sem texto)...")
-            canvas_w, canvas_h = 1080, 1920
+            produto = self.preparar_produto(img_produto)
+            canvas_w, canvas_h = CANVAS_VERTICAL
             canvas = Image.new('RGB', (canvas_w, canvas_h), (255, 255, 255))
+            box_w, box_h = CAIXA_VERTICAL_W, CAIXA_VERTICAL_H
 
-            box_w = 800
-            base_max_h = 1500
-            margem_px = int(0.05 * min(canvas_w, canvas_h))
-            box_h = min(2 * base_max_h, canvas_h - 2 * margem_px)
-
-            if img_produto.mode == 'RGBA':
-                base_rgb = Image.new('RGB', img_produto.size, (255, 255, 255))
-                base_rgb.paste(img_produto, mask=img_produto.split()[-1])
-                rgb = base_rgb
-            else:
-                rgb = img_produto.convert('RGB') if img_produto.mode != 'RGB' else img_produto
-
-            w0, h0 = rgb.size
-            if w0 <= 0 or h0 <= 0:
-                raise ValueError("Dimensões inválidas da imagem do produto")
-
-            white_bg = Image.new('RGB', (w0, h0), (255, 255, 255))
-            diff = ImageChops.difference(rgb, white_bg)
-            gray = diff.convert('L')
-            mask = gray.point(lambda p: 255 if p > self.DIFF_T else 0)
-            mask = mask.filter(ImageFilter.MaxFilter(3))
-            bbox = mask.getbbox()
-
-            crop_img = rgb
-            used_crop = False
-            if bbox:
-                left, top, right, bottom = bbox
-                pad = int(0.02 * min(w0, h0))
-                left = max(0, left - pad)
-                top = max(0, top - pad)
-                right = min(w0, right + pad)
-                bottom = min(h0, bottom + pad)
-                if right - left > 10 and bottom - top > 10:
-                    crop_img = rgb.crop((left, top, right, bottom))
-                    used_crop = True
-
-            cw, ch = crop_img.size
+            w0, h0 = produto.w0, produto.h0
+            cw, ch = produto.crop.size
 
             old_scale = min(box_w / float(w0), box_h / float(h0))
-            new_scale_base = min(box_w / float(cw), box_h / float(ch))
+            new_scale_base = produto.escala_caixa()
             target_scale = new_scale_base
             if new_scale_base >= 2.0 * old_scale:
                 target_scale = 2.0 * old_scale
             target_scale = min(target_scale, new_scale_base)
 
-            new_w = max(1, int(round(cw * target_scale)))
-            new_h = max(1, int(round(ch * target_scale)))
+            img_redim = produto.redimensionar(target_scale)
+            new_w, new_h = img_redim.size
 
             logger.info(
                 f"📐 1080x1920 | box {box_w}x{box_h} | origem {w0}x{h0} | "
-                f"{'crop ' if used_crop else ''}{cw}x{ch} | "
+                f"{'crop ' if produto.used_crop else ''}{cw}x{ch} | "
                 f"esc_old {old_scale:.3f} esc_new {new_scale_base:.3f} -> final {new_w}x{new_h}"
             )
 
-            img_redim = crop_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-
             pos_x = (canvas_w - new_w) // 2
             pos_y = (canvas_h - new_h) // 2
             canvas.paste(img_redim, (pos_x, pos_y))
 
-            buffer = io.BytesIO()
-            canvas.save(buffer, format='PNG', quality=95)
-            buffer.seek(0)
+            buffer = self._codificar(canvas, 'sorteio_1080x1920')
             logger.info("✅ Imagem 1080x1920 pronta")
             return buffer, "Imagem 1080x1920 gerada"
         except Exception as e:
@@ -669,71 +2464,19 @@ class ProcessadorSorteioV5:
     def processar_imagem_vertical_1080x1920_mascarada(self, img_produto):
         try:
             logger.info("🎨 Processando imagem vertical 1080x1920 mascarada...")
-            canvas_w, canvas_h = 1080, 1920
+            produto = self.preparar_produto(img_produto)
+            canvas_w, canvas_h = CANVAS_VERTICAL
             base_canvas = Image.new('RGB', (canvas_w, canvas_h), (255, 255, 255))
 
-            box_w = 800
-            base_max_h = 1500
-            margem_px = int(0.05 * min(canvas_w, canvas_h))
-            box_h = min(2 * base_max_h, canvas_h - 2 * margem_px)
-
-            if img_produto.mode == 'RGBA':
-                tmp = Image.new('RGB', img_produto.size, (255, 255, 255))
-                tmp.paste(img_produto, mask=img_produto.split()[-1])
-                rgb = tmp
-            else:
-                rgb = img_produto.convert('RGB') if img_produto.mode != 'RGB' else img_produto
-
-            w0, h0 = rgb.size
-            white_bg = Image.new('RGB', (w0, h0), (255, 255, 255))
-            diff = ImageChops.difference(rgb, white_bg)
-            gray = diff.convert('L')
-            mask = gray.point(lambda p: 255 if p > self.DIFF_T else 0)
-            mask = mask.filter(ImageFilter.MaxFilter(3))
-            bbox = mask.getbbox()
-
-            crop_img = rgb
-            if bbox:
-                left, top, right, bottom = bbox
-                pad = int(0.02 * min(w0, h0))
-                left = max(0, left - pad)
-                top = max(0, top - pad)
-                right = min(w0, right + pad)
-                bottom = min(h0, bottom + pad)
-                if right - left > 10 and bottom - top > 10:
-                    crop_img = rgb.crop((left, top, right, bottom))
-
-            cw, ch = crop_img.size
-            scale = min(box_w / float(cw), box_h / float(ch))
-            new_w = max(1, int(round(cw * scale)))
-            new_h = max(1, int(round(ch * scale)))
-            img_redim = crop_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+            img_redim = produto.redimensionar(produto.escala_caixa())
+            new_w, new_h = img_redim.size
 
             pos_x = (canvas_w - new_w) // 2
             pos_y = (canvas_h - new_h) // 2
             base_canvas.paste(img_redim, (pos_x, pos_y))
 
-            overlay = Image.new('RGBA', (canvas_w, canvas_h), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(overlay)
-
-            card_w = min(720, int(new_w * 0.7))
-            s = card_w / 720.0
-            pad = int(24 * s)
-
-            f1, f2, f3 = self._load_fonts(int(90 * s), int(48 * s), int(90 * s))
-            texto1 = "ADIVINHE"
-            texto2 = "e ganhe esse"
-            texto3 = "PRODUTO"
-
-            def tbox(t, f):
-                return draw.textbbox((0, 0), t, font=f)
-            b1 = tbox(texto1, f1); b2 = tbox(texto2, f2); b3 = tbox(texto3, f3)
-            line_h1 = b1[3] - b1[1]
-            line_h2 = b2[3] - b2[1]
-            line_h3 = b3[3] - b3[1]
-            spacing = int(12 * s)
-
-            card_h = pad + line_h1 + spacing + line_h2 + spacing + line_h3 + pad
+            card_w = quantizar_largura(min(720, int(new_w * 0.7)))
+            _, _, card_h = metricas_cartao_mascarado(card_w)
 
             cx = pos_x + new_w // 2
             cy = pos_y + int(new_h * 0.55)
@@ -743,37 +2486,10 @@ class ProcessadorSorteioV5:
             y1 = min(canvas_h, y0 + card_h)
             x0 = int(x0); y0 = int(y0); x1 = int(x1); y1 = int(y1)
 
-            radius = int(28 * s)
-            vermelho = (200, 0, 0, 230)  # ~90% opacidade
-            sombra = (0, 0, 0, 90)
-            draw.rounded_rectangle((x0+3, y0+4, x1+3, y1+4), radius=radius, fill=sombra)
-            draw.rounded_rectangle((x0, y0, x1, y1), radius=radius, fill=vermelho)
-
-            tx = x0 + (x1 - x0) // 2
-            cursor_y = y0 + pad
-            branco90 = (255, 255, 255, 230)
-
-            def draw_center(t, f, y):
-                bbox = draw.textbbox((0, 0), t, font=f)
-                tw = bbox[2] - bbox[0]
-                x = tx - tw // 2
-                for dx, dy in ((1,0),(0,1),(-1,0),(0,-1)):
-                    draw.text((x+dx, y+dy), t, font=f, fill=(0,0,0,60))
-                draw.text((x, y), t, font=f, fill=branco90)
-                return y + (bbox[3]-bbox[1])
-
-            cursor_y = draw_center(texto1, f1, cursor_y)
-            cursor_y += spacing
-            cursor_y = draw_center(texto2, f2, cursor_y)
-            cursor_y += spacing
-            _ = draw_center(texto3, f3, cursor_y)
-
-            out = base_canvas.convert('RGBA')
-            out = Image.alpha_composite(out, overlay).convert('RGB')
-
-            buffer = io.BytesIO()
-            out.save(buffer, format='PNG', quality=95)
-            buffer.seek(0)
+            camada = camada_cartao_mascarado(card_w, x1 - x0, y1 - y0)
+            out = compor_camada(base_canvas, camada, x0 - MARGEM_CAMADA, y0 - MARGEM_CAMADA)
+
+            buffer = self._codificar(out, 'sorteio_1080x1920_mask')
             logger.info("✅ Imagem 1080x1920 mascarada pronta")
             return buffer, "Imagem 1080x1920 mascarada gerada"
         except Exception as e:
@@ -784,104 +2500,45 @@ class ProcessadorSorteioV5:
     def processar_imagem_vertical_1080x1920_teaser_q(self, img_produto):
         try:
             logger.info("🎨 Processando imagem vertical 1080x1920 com '?'...")
-            canvas_w, canvas_h = 1080, 1920
+            produto = self.preparar_produto(img_produto)
+            canvas_w, canvas_h = CANVAS_VERTICAL
             base_canvas = Image.new('RGB', (canvas_w, canvas_h), (255, 255, 255))
 
-            box_w = 800
-            base_max_h = 1500
-            margem_px = int(0.05 * min(canvas_w, canvas_h))
-            box_h = min(2 * base_max_h, canvas_h - 2 * margem_px)
-
-            if img_produto.mode == 'RGBA':
-                tmp = Image.new('RGB', img_produto.size, (255, 255, 255))
-                tmp.paste(img_produto, mask=img_produto.split()[-1])
-                rgb = tmp
-            else:
-                rgb = img_produto.convert('RGB') if img_produto.mode != 'RGB' else img_produto
-
-            w0, h0 = rgb.size
-            white_bg = Image.new('RGB', (w0, h0), (255, 255, 255))
-            diff = ImageChops.difference(rgb, white_bg)
-            gray = diff.convert('L')
-            mask = gray.point(lambda p: 255 if p > self.DIFF_T else 0)
-            mask = mask.filter(ImageFilter.MaxFilter(3))
-            bbox = mask.getbbox()
-
-            crop_img = rgb
-            if bbox:
-                left, top, right, bottom = bbox
-                pad = int(0.02 * min(w0, h0))
-                left = max(0, left - pad)
-                top = max(0, top - pad)
-                right = min(w0, right + pad)
-                bottom = min(h0, bottom + pad)
-                if right - left > 10 and bottom - top > 10:
-                    crop_img = rgb.crop((left, top, right, bottom))
-
-            cw, ch = crop_img.size
-            scale = min(box_w / float(cw), box_h / float(ch))
-            new_w = max(1, int(round(cw * scale)))
-            new_h = max(1, int(round(ch * scale)))
-            img_redim = crop_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+            img_redim = produto.redimensionar(produto.escala_caixa())
+            new_w, new_h = img_redim.size
 
             pos_x = (canvas_w - new_w) // 2
             pos_y = (canvas_h - new_h) // 2
             base_canvas.paste(img_redim, (pos_x, pos_y))
 
-            overlay = Image.new('RGBA', (canvas_w, canvas_h), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(overlay)
-
             # Círculo central
             diam = int(canvas_w * 0.58)  # 58% da largura
             cx = canvas_w // 2
             cy = pos_y + new_h // 2
-            x0 = cx - diam // 2
-            y0 = cy - diam // 2
-            x1 = cx + diam // 2
-            y1 = cy + diam // 2
-
-            # sombra leve
-            draw.ellipse((x0+4, y0+6, x1+4, y1+6), fill=(0, 0, 0, 80))
-            draw.ellipse((x0, y0, x1, y1), fill=(200, 0, 0, 230))
+            camada = camada_circulo_interrogacao(diam)
+            out = compor_camada(base_canvas, camada, cx - diam // 2 - MARGEM_CAMADA, cy - diam // 2 - MARGEM_CAMADA)
 
-            # "?" central
-            try:
-                f_q = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", int(diam * 0.8))
-            except:
-                try:
-                    f_q = ImageFont.truetype("arialbd.ttf", int(diam * 0.8))
-                except:
-                    f_q = ImageFont.load_default()
-
-            q_bbox = draw.textbbox((0, 0), "?", font=f_q)
-            q_w = q_bbox[2] - q_bbox[0]
-            q_h = q_bbox[3] - q_bbox[1]
-            q_x = cx - q_w // 2
-            q_y = cy - q_h // 2
-            # borda sutil
-            for dx, dy in ((1,0),(0,1),(-1,0),(0,-1)):
-                draw.text((q_x+dx, q_y+dy), "?", font=f_q, fill=(0,0,0,70))
-            draw.text((q_x, q_y), "?", font=f_q, fill=(255,255,255,240))
-
-            out = base_canvas.convert('RGBA')
-            out = Image.alpha_composite(out, overlay).convert('RGB')
-
-            buffer = io.BytesIO()
-            out.save(buffer, format='PNG', quality=95)
-            buffer.seek(0)
+            buffer = self._codificar(out, 'sorteio_1080x1920_q')
             logger.info("✅ Imagem 1080x1920 '?' pronta")
             return buffer, "Imagem 1080x1920 '?' gerada"
         except Exception as e:
             logger.error(f"❌ Erro no processamento 1080x1920 '?': {e}")
             return None, f"Erro no processamento 1080x1920 '?': {str(e)}"
 
-    def upload_catbox(self, buffer_imagem, nome_arquivo='sorteio.png'):
+    def _codificar(self, imagem, variante):
+        codificador = codificador_variante(variante)
+        buffer, tamanho, duracao = codificador.codificar(imagem)
+        logger.info(f"💾 {variante}: {codificador.formato.upper()} {tamanho / 1024:.0f} KB em {duracao * 1000:.0f} ms")
+        return buffer
+
+    def upload_catbox(self, buffer_imagem, nome_arquivo='sorteio.png', mime='image/png'):
         try:
             logger.info("📤 Upload para Catbox.moe...")
             buffer_imagem.seek(0)
-            files = {'fileToUpload': (nome_arquivo, buffer_imagem, 'image/png')}
+            files = {'fileToUpload': (nome_arquivo, buffer_imagem, mime)}
             data = {'reqtype': 'fileupload'}
             headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+            limitador_hosts.aguardar('https://catbox.moe/user/api.php')
             response = requests.post('https://catbox.moe/user/api.php', files=files, data=data, headers=headers, timeout=60)
             logger.info(f"📊 Status Code: {response.status_code}")
             if response.status_code == 200:
@@ -899,61 +2556,81 @@ class ProcessadorSorteioV5:
             logger.error(f"❌ Erro no upload: {e}")
             return None, f"Erro no upload: {str(e)}"
 
+    # Variantes na ordem de renderização: (renderizador, arquivo no Catbox, rótulo).
+    # A primeira (600x600) é obrigatória; falhas nas demais só ficam registradas no log.
+    VARIANTES = (
+        ('processar_imagem_sorteio', 'sorteio_600.png', '600x600'),
+        ('processar_imagem_vertical_1080x1920', 'sorteio_1080x1920.png', '1080x1920'),
+        ('processar_imagem_vertical_1080x1920_mascarada', 'sorteio_1080x1920_mask.png', '1080x1920 mascarada'),
+        ('processar_imagem_vertical_1080x1920_teaser_q', 'sorteio_1080x1920_q.png', "1080x1920 '?'"),
+    )
+
+    def _renderizar_e_enviar(self, produto):
+        # Renderiza as variantes em sequência e dispara cada upload assim que a imagem fica
+        # pronta, de modo que a renderização da próxima se sobrepõe ao envio da anterior.
+        executor = ThreadPoolExecutor(max_workers=max(1, UPLOAD_WORKERS))
+        try:
+            uploads = []
+            for i, (metodo, nome_arquivo, rotulo) in enumerate(self.VARIANTES):
+                if uploads and uploads[0].done() and not uploads[0].result()[0]:
+                    break  # upload obrigatório já falhou, não adianta renderizar o resto
+                buffer, msg_processamento = getattr(self, metodo)(produto)
+                if not buffer:
+                    if i == 0:
+                        return None, f"❌ Processamento falhou ({rotulo}): {msg_processamento}"
+                    logger.error(f"⚠️ Falha ao gerar {rotulo}: {msg_processamento}")
+                    uploads.append(None)
+                    continue
+                nome_envio, mime = codificador_variante(nome_arquivo).arquivo(nome_arquivo)
+                uploads.append(executor.submit(self.upload_catbox, buffer, nome_arquivo=nome_envio, mime=mime))
+
+            url_principal, msg_upload = uploads[0].result()
+            if not url_principal:
+                return None, f"❌ Upload falhou ({self.VARIANTES[0][2]}): {msg_upload}"
+
+            urls = [url_principal]
+            for (_, _, rotulo), futuro in zip(self.VARIANTES[1:], uploads[1:]):
+                url = None
+                if futuro is not None:
+                    url, msg_upload = futuro.result()
+                    if not url:
+                        logger.error(f"⚠️ Falha upload {rotulo}: {msg_upload}")
+                urls.append(url)
+            return urls, None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def processar_produto_completo(self, url_produto):
         try:
             logger.info(f"🚀 PROCESSAMENTO V5.0: {url_produto}")
             codigo = self.extrair_codigo_produto(url_produto)
             if not codigo:
                 return None, None, None, None, "❌ Código NATBRA não encontrado na URL"
+            urls = cache_imagens.buscar_por_codigo(codigo)
+            if urls:
+                logger.info(f"♻️ Cache: {codigo} já processado, reutilizando URLs")
+                return (*urls, "✅ Produto processado com sucesso (cache)")
             candidatas, msg_extracao = self.extrair_imagens_por_codigo(url_produto, codigo)
             if not candidatas:
                 return None, None, None, None, f"❌ Extração falhou: {msg_extracao}"
-            img_produto, msg_selecao = self.avaliar_e_selecionar_imagem(candidatas)
-            if not img_produto:
+            melhor, msg_selecao = self.selecionar_candidata(candidatas)
+            if not melhor:
                 return None, None, None, None, f"❌ Seleção falhou: {msg_selecao}"
 
-            img_base1 = img_produto.copy()
-            img_base2 = img_produto.copy()
-            img_base3 = img_produto.copy()
-            img_base4 = img_produto.copy()
-
-            # imagem 1: 600x600 com textos
-            buffer_600, msg_processamento_600 = self.processar_imagem_sorteio(img_base1)
-            if not buffer_600:
-                return None, None, None, None, f"❌ Processamento falhou (600x600): {msg_processamento_600}"
-            url_600, msg_upload_600 = self.upload_catbox(buffer_600, nome_arquivo='sorteio_600.png')
-            if not url_600:
-                return None, None, None, None, f"❌ Upload falhou (600x600): {msg_upload_600}"
-
-            # imagem 2: 1080x1920 sem textos
-            buffer_1080, msg_processamento_1080 = self.processar_imagem_vertical_1080x1920(img_base2)
-            url_1080 = None
-            if buffer_1080:
-                url_1080, msg_upload_1080 = self.upload_catbox(buffer_1080, nome_arquivo='sorteio_1080x1920.png')
-                if not url_1080:
-                    logger.error(f"⚠️ Falha upload 1080x1920: {msg_upload_1080}")
-            else:
-                logger.error(f"⚠️ Falha ao gerar 1080x1920: {msg_processamento_1080}")
-
-            # imagem 3: 1080x1920 mascarada (texto)
-            buffer_mask, msg_mask = self.processar_imagem_vertical_1080x1920_mascarada(img_base3)
-            url_1080_mask = None
-            if buffer_mask:
-                url_1080_mask, msg_upload_mask = self.upload_catbox(buffer_mask, nome_arquivo='sorteio_1080x1920_mask.png')
-                if not url_1080_mask:
-                    logger.error(f"⚠️ Falha upload 1080x1920 mascarada: {msg_upload_mask}")
-            else:
-                logger.error(f"⚠️ Falha ao gerar 1080x1920 mascarada: {msg_mask}")
-
-            # imagem 4: 1080x1920 com '?'
-            buffer_q, msg_q = self.processar_imagem_vertical_1080x1920_teaser_q(img_base4)
-            url_1080_q = None
-            if buffer_q:
-                url_1080_q, msg_upload_q = self.upload_catbox(buffer_q, nome_arquivo='sorteio_1080x1920_q.png')
-                if not url_1080_q:
-                    logger.error(f"⚠️ Falha upload 1080x1920 '?': {msg_upload_q}")
-            else:
-                logger.error(f"⚠️ Falha ao gerar 1080x1920 '?': {msg_q}")
+            urls = cache_imagens.buscar_por_hash(melhor['sha256'])
+            if urls:
+                logger.info(f"♻️ Cache: imagem de origem de {codigo} já processada, reutilizando URLs")
+                cache_imagens.salvar(codigo, melhor['sha256'], urls)
+                return (*urls, "✅ Produto processado com sucesso (cache)")
+
+            # recorte/máscara calculados uma vez para as quatro variantes
+            produto = self.preparar_produto(melhor['imagem'])
+            urls, erro = self._renderizar_e_enviar(produto)
+            if erro:
+                return None, None, None, None, erro
+            url_600, url_1080, url_1080_mask, url_1080_q = urls
+            if all(urls):
+                cache_imagens.salvar(codigo, melhor['sha256'], urls)
 
             logger.info(f"🎉 SUCESSO: 600x600={url_600} | 1080x1920={url_1080} | 1080x1920_mask={url_1080_mask} | 1080x1920_q={url_1080_q}")
             return url_600, url_1080, url_1080_mask, url_1080_q, "✅ Produto processado com sucesso"
@@ -967,6 +2644,14 @@ class ProcessadorSorteioV5:
 class GoogleSheetsManager:
     def __init__(self):
         self.planilha = None
+        self._worksheet = None
+        # Mapa de colunas derivado do cabeçalho (linha 1); refeito só quando o cabeçalho muda
+        self._cabecalho = None
+        self._colunas = None
+        # (linha, coluna) -> valor, na ordem em que foram escritas; vai para o Sheets em lote
+        self._celulas_pendentes = {}
+        self._ultima_descarga = time.monotonic()
+        self._lock = threading.Lock()
         self.conectar()
     
     def conectar(self):
@@ -980,19 +2665,54 @@ class GoogleSheetsManager:
             creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
             client = gspread.authorize(creds)
             self.planilha = client.open_by_key(PLANILHA_ID)
+            self._worksheet = None
             logger.info("✅ Conectado ao Google Sheets com sucesso")
             return True
         except Exception as e:
             logger.error(f"❌ Erro ao conectar Google Sheets: {e}")
             self.planilha = None
             return False
+
+    def _obter_worksheet(self):
+        if self._worksheet is None:
+            self._worksheet = self.planilha.get_worksheet(0)
+        return self._worksheet
     
+    @staticmethod
+    def _mapear_colunas(headers):
+        colunas = {'status': None, 'imagem': None, 'erro': None, 'imagem2': None, 'imagem3': None, 'imagem4': None}
+        for i, header in enumerate(headers, 1):
+            h = str(header).lower()
+            if 'status' in h:
+                colunas['status'] = i
+            elif ('imagem' in h or 'resultado' in h) and colunas['imagem'] is None:
+                colunas['imagem'] = i
+            elif 'erro' in h or 'observ' in h:
+                colunas['erro'] = i
+            if ('produto 2' in h) or ('url do produto 2' in h):
+                colunas['imagem2'] = i
+            if ('produto 3' in h) or ('url do produto 3' in h):
+                colunas['imagem3'] = i
+            if ('produto 4' in h) or ('url do produto 4' in h):
+                colunas['imagem4'] = i
+        return colunas
+
+    def _atualizar_cabecalho(self, headers):
+        cabecalho = tuple(headers)
+        if cabecalho != self._cabecalho:
+            self._cabecalho = cabecalho
+            self._colunas = self._mapear_colunas(cabecalho)
+            logger.info(f"🗂️ Mapa de colunas da planilha: {self._colunas}")
+
     def obter_produtos_pendentes(self):
         try:
             if not self.planilha and not self.conectar():
                 return []
-            worksheet = self.planilha.get_worksheet(0)
+            worksheet = self._obter_worksheet()
             dados = worksheet.get_all_records()
+            if dados:
+                # as chaves de get_all_records são o cabeçalho inteiro, na ordem das colunas
+                self._atualizar_cabecalho(list(dados[0].keys()))
             produtos_pendentes = []
             for i, linha in enumerate(dados, start=2):
                 url_produto = linha.get('URL do Produto', '').strip()
@@ -1006,66 +2726,114 @@ class GoogleSheetsManager:
             return []
     
     def atualizar_resultado(self, linha, url_imagem=None, erro=None, url_imagem2=None, url_imagem3=None, url_imagem4=None):
+        # As células só são enfileiradas; descarregar() as envia em lote.
         try:
             if not self.planilha and not self.conectar():
                 return False
-            worksheet = self.planilha.get_worksheet(0)
-            headers = worksheet.row_values(1)
-            col_status = None
-            col_imagem = None
-            col_erro = None
-            col_imagem2 = None
-            col_imagem3 = None
-            col_imagem4 = None
-            for i, header in enumerate(headers, 1):
-                h = header.lower()
-                if 'status' in h:
-                    col_status = i
-                elif ('imagem' in h or 'resultado' in h) and col_imagem is None:
-                    col_imagem = i
-                elif 'erro' in h or 'observ' in h:
-                    col_erro = i
-                if ('produto 2' in h) or ('url do produto 2' in h):
-                    col_imagem2 = i
-                if ('produto 3' in h) or ('url do produto 3' in h):
-                    col_imagem3 = i
-                if ('produto 4' in h) or ('url do produto 4' in h):
-                    col_imagem4 = i
-
+            if self._colunas is None:
+                self._atualizar_cabecalho(self._obter_worksheet().row_values(1))
+            col_status = self._colunas['status']
+            col_imagem = self._colunas['imagem']
+            col_erro = self._colunas['erro']
+            col_imagem2 = self._colunas['imagem2']
+            col_imagem3 = self._colunas['imagem3']
+            col_imagem4 = self._colunas['imagem4']
+
+            celulas = []
             if url_imagem:
                 if col_status:
-                    worksheet.update_cell(linha, col_status, "✅ Processado")
+                    celulas.append((col_status, "✅ Processado"))
                 if col_imagem:
-                    worksheet.update_cell(linha, col_imagem, url_imagem)
+                    celulas.append((col_imagem, url_imagem))
                 if url_imagem2 and col_imagem2:
-                    worksheet.update_cell(linha, col_imagem2, url_imagem2)
+                    celulas.append((col_imagem2, url_imagem2))
                 if url_imagem3 and col_imagem3:
-                    worksheet.update_cell(linha, col_imagem3, url_imagem3)
+                    celulas.append((col_imagem3, url_imagem3))
                 if url_imagem4 and col_imagem4:
-                    worksheet.update_cell(linha, col_imagem4, url_imagem4)
+                    celulas.append((col_imagem4, url_imagem4))
                 if col_erro:
-                    worksheet.update_cell(linha, col_erro, "")
-                logger.info(f"✅ Linha {linha} atualizada com sucesso")
+                    celulas.append((col_erro, ""))
+                logger.info(f"✅ Linha {linha} enfileirada com sucesso")
             else:
                 if col_status:
-                    worksheet.update_cell(linha, col_status, "❌ Erro")
+                    celulas.append((col_status, "❌ Erro"))
                 if col_erro:
-                    worksheet.update_cell(linha, col_erro, erro or "Erro desconhecido")
-                logger.info(f"❌ Linha {linha} atualizada com erro")
+                    celulas.append((col_erro, erro or "Erro desconhecido"))
+                logger.info(f"❌ Linha {linha} enfileirada com erro")
+
+            with self._lock:
+                for coluna, valor in celulas:
+                    self._celulas_pendentes.pop((linha, coluna), None)
+                    self._celulas_pendentes[(linha, coluna)] = valor
+                linhas = len({l for l, _ in self._celulas_pendentes})
+                vencido = time.monotonic() - self._ultima_descarga >= SHEETS_LOTE_SEGUNDOS
+            if linhas >= SHEETS_LOTE_LINHAS or vencido:
+                return self.descarregar()
             return True
         except Exception as e:
             logger.error(f"❌ Erro ao atualizar planilha: {e}")
             return False
 
+    def descarregar(self):
+        # Envia todas as células pendentes num único values:batchUpdate
+        with self._lock:
+            pendentes = self._celulas_pendentes
+            self._celulas_pendentes = {}
+            self._ultima_descarga = time.monotonic()
+        if not pendentes:
+            return True
+        try:
+            if not self.planilha and not self.conectar():
+                raise RuntimeError("Sem conexão com o Google Sheets")
+            dados = [{'range': rowcol_to_a1(linha, coluna), 'values': [[valor]]}
+                     for (linha, coluna), valor in pendentes.items()]
+            self._obter_worksheet().batch_update(dados, value_input_option=ValueInputOption.user_entered)
+            linhas = len({linha for linha, _ in pendentes})
+            logger.info(f"📤 Planilha atualizada em lote: {len(pendentes)} célula(s) de {linhas} linha(s)")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Erro ao gravar lote na planilha: {e}")
+            with self._lock:
+                # devolve à fila sem sobrescrever valores mais novos da mesma célula
+                for chave, valor in pendentes.items():
+                    self._celulas_pendentes.setdefault(chave, valor)
+            return False
+
+    def descarregar_final(self):
+        # Última descarga da execução: o gerenciador é descartado em seguida, então uma falha
+        # aqui perderia o lote inteiro. Tenta de novo após reconectar e, se ainda falhar,
+        # retorna {linha: {coluna: valor}} do que não foi gravado (vazio = tudo gravado).
+        if self.descarregar():
+            return {}
+        logger.warning("🔁 Reconectando ao Google Sheets para repetir a última descarga...")
+        if self.conectar() and self.descarregar():
+            return {}
+        with self._lock:
+            pendentes = self._celulas_pendentes
+            self._celulas_pendentes = {}
+        perdidas = {}
+        for (linha, coluna), valor in pendentes.items():
+            perdidas.setdefault(linha, {})[coluna] = valor
+        for linha, celulas in sorted(perdidas.items()):
+            logger.error(f"❌ Linha {linha} NÃO gravada na planilha (coluna: valor): {celulas}")
+        return perdidas
+
 # ================================
 # AUTOMAÇÃO PRINCIPAL
 # ================================
+def _processar_produto_cronometrado(processador, produto):
+    logger.info(f"🔄 Processando linha {produto['linha']}: {produto['url']}")
+    inicio = time.monotonic()
+    resultado = processador.processar_produto_completo(produto['url'])
+    return resultado, round(time.monotonic() - inicio, 2)
+
 def executar_processamento_automatico():
     global sistema_status
     try:
         logger.info("🚀 INICIANDO PROCESSAMENTO AUTOMÁTICO V5.0")
         sistema_status["status"] = "Processando produtos..."
         sistema_status["ultima_execucao"] = datetime.now().isoformat()
+        sistema_status["falha_planilha"] = None
         sheets_manager = GoogleSheetsManager()
         processador = ProcessadorSorteioV5()
         produtos = sheets_manager.obter_produtos_pendentes()
@@ -1073,35 +2841,65 @@ def executar_processamento_automatico():
             logger.info("📋 Nenhum produto pendente encontrado")
             sistema_status["status"] = "Nenhum produto pendente. Sistema em standby."
             return
-        logger.info(f"📋 Processando {len(produtos)} produtos...")
+        logger.info(f"📋 Processando {len(produtos)} produtos com {PROCESSAMENTO_WORKERS} worker(s)...")
         sucessos = 0
         erros = 0
-        for produto in produtos:
-            try:
-                logger.info(f"🔄 Processando linha {produto['linha']}: {produto['url']}")
-                url_imagem, url_imagem2, url_imagem3, url_imagem4, mensagem = processador.processar_produto_completo(produto['url'])
-                if url_imagem:
-                    sheets_manager.atualizar_resultado(
-                        produto['linha'],
-                        url_imagem=url_imagem,
-                        url_imagem2=url_imagem2,
-                        url_imagem3=url_imagem3,
-                        url_imagem4=url_imagem4
-                    )
-                    sucessos += 1
-                    logger.info(f"✅ Linha {produto['linha']} processada com sucesso")
-                else:
-                    sheets_manager.atualizar_resultado(produto['linha'], erro=mensagem)
-                    erros += 1
-                    logger.error(f"❌ Linha {produto['linha']} falhou: {mensagem}")
-                time.sleep(2)
-            except Exception as e:
-                logger.error(f"❌ Erro ao processar linha {produto['linha']}: {e}")
-                sheets_manager.atualizar_resultado(produto['linha'], erro=str(e))
-                erros += 1
+        latencias = []
+        inicio = time.monotonic()
+        # Os produtos rodam em paralelo; a planilha só é escrita nesta thread.
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, PROCESSAMENTO_WORKERS)) as executor:
+                futuros = {executor.submit(_processar_produto_cronometrado, processador, produto): produto
+                           for produto in produtos}
+                for futuro in as_completed(futuros):
+                    produto = futuros[futuro]
+                    try:
+                        (url_imagem, url_imagem2, url_imagem3, url_imagem4, mensagem), duracao = futuro.result()
+                        latencias.append(duracao)
+                        if url_imagem:
+                            sheets_manager.atualizar_resultado(
+                                produto['linha'],
+                                url_imagem=url_imagem,
+                                url_imagem2=url_imagem2,
+                                url_imagem3=url_imagem3,
+                                url_imagem4=url_imagem4
+                            )
+                            sucessos += 1
+                            logger.info(f"✅ Linha {produto['linha']} processada com sucesso ({duracao:.1f}s)")
+                        else:
+                            sheets_manager.atualizar_resultado(produto['linha'], erro=mensagem)
+                            erros += 1
+                            logger.error(f"❌ Linha {produto['linha']} falhou: {mensagem}")
+                    except Exception as e:
+                        logger.error(f"❌ Erro ao processar linha {produto['linha']}: {e}")
+                        sheets_manager.atualizar_resultado(produto['linha'], erro=str(e))
+                        erros += 1
+        finally:
+            perdidas = sheets_manager.descarregar_final()
+            if perdidas:
+                sistema_status["falha_planilha"] = {
+                    "linhas": sorted(perdidas),
+                    "celulas": {str(linha): {str(c): v for c, v in celulas.items()} for linha, celulas in perdidas.items()},
+                }
+        duracao_total = time.monotonic() - inicio
+        latencias.sort()
+        sistema_status["resumo_execucao"] = {
+            "produtos": len(produtos),
+            "workers": PROCESSAMENTO_WORKERS,
+            "duracao_total_s": round(duracao_total, 2),
+            "produtos_por_minuto": round(len(produtos) * 60.0 / duracao_total, 2) if duracao_total > 0 else None,
+            "latencia_p50_s": _percentil(latencias, 50),
+            "latencia_p90_s": _percentil(latencias, 90),
+            "latencia_p99_s": _percentil(latencias, 99),
+            "latencia_max_s": latencias[-1] if latencias else None,
+        }
         sistema_status["produtos_processados"] = sucessos
         sistema_status["erros"] = erros
         sistema_status["status"] = f"Processamento concluído. {sucessos} sucessos, {erros} erros."
+        if perdidas:
+            sistema_status["status"] = (f"Processamento com FALHA na planilha: {len(perdidas)} linha(s) não gravada(s) "
+                                        f"{sorted(perdidas)}. {sucessos} sucessos, {erros} erros.")
+            logger.error(f"❌ {len(perdidas)} linha(s) processada(s) sem resultado gravado na planilha")
         logger.info(f"🎉 PROCESSAMENTO CONCLUÍDO: {sucessos} sucessos, {erros} erros")
     except Exception as e:
         logger.error(f"❌ Erro no processamento automático: {e}")
@@ -1200,9 +2998,7 @@ def dashboard():
     </body>
     </html>
     """
-    agora = time.time()
-    conversas_ativas = sum(1 for conversa in user_conversations.values() 
-                           if agora - conversa['last_activity'] < TIMEOUT_CONVERSA)
+    conversas_ativas = len(armazem_conversas)
     return render_template_string(html, status=sistema_status, conversas_ativas=conversas_ativas)
 
 @app.route('/api/sorteios/health')
@@ -1225,9 +3021,11 @@ def status_sistema():
         "timestamp": datetime.now().isoformat(),
         "version": "6.0",
         "manychat": {
-            "conversas_ativas": len(user_conversations),
+            "conversas_ativas": len(armazem_conversas),
             "timeout_conversa": TIMEOUT_CONVERSA
-        }
+        },
+        "cache_imagens": cache_imagens.estatisticas(),
+        "codificacao": estatisticas_codificacao()
     })
 
 # aceitar GET e POST para o cron HTTP